@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+import argparse
+import pathlib
+import sys
+import time
+
+root = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(root))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser('Benchmarks')
+    cmds = parser.add_subparsers(title='commands')
+
+    def cmd(name, **kw):
+        p = cmds.add_parser(name, **kw)
+        p.set_defaults(cmd=name)
+        p.arg = lambda *a, **kw: p.add_argument(*a, **kw) and p
+        p.exe = lambda f: p.set_defaults(exe=f) or p
+        return p
+
+    cmd('fetch-parser')\
+        .exe(lambda a: fetch_parser(a.count))\
+        .arg('-c', '--count', type=int, default=100000)
+
+    cmd('thread-parser')\
+        .exe(lambda a: thread_parser(a.count))\
+        .arg('-c', '--count', type=int, default=300000)
+
+    cmd('append')\
+        .exe(lambda a: append(a.count, a.size))\
+        .arg('-c', '--count', type=int, default=8)\
+        .arg('-s', '--size', type=int, default=25, help='message size in MB')
+
+    cmd('fetch-body')\
+        .exe(lambda a: fetch_body(a.count, a.size))\
+        .arg('-c', '--count', type=int, default=20000)\
+        .arg('-s', '--size', type=int, default=10, help='message size in KB')
+
+    cmd('metadata')\
+        .exe(lambda a: metadata(a.count, a.addrs))\
+        .arg('-c', '--count', type=int, default=300000)\
+        .arg('-a', '--addrs', type=int, default=3000, help='unique senders')
+
+    args = parser.parse_args(sys.argv[1:])
+    if not hasattr(args, 'cmd'):
+        parser.print_usage()
+        exit(2)
+    elif hasattr(args, 'exe'):
+        try:
+            args.exe(args)
+        except KeyboardInterrupt:
+            raise SystemExit('^C')
+    else:
+        raise ValueError('Wrong subcommand')
+
+
+def timeit(label, fn, *args):
+    start = time.perf_counter()
+    res = fn(*args)
+    duration = time.perf_counter() - start
+    print('%-12s %.3fs' % (label, duration))
+    return res, duration
+
+
+def fetch_parser(count):
+    import re
+
+    from mailur import imap
+
+    def flags_regex(res):
+        items = []
+        for line in res:
+            pattern = r'UID (\d+) FLAGS \(([^)]*)\)'
+            uid, flags = re.search(pattern, line.decode()).groups()
+            items.append((uid, flags))
+        return items
+
+    def flags_parser(res):
+        return list(imap.fetch_flags(res))
+
+    def flags_items(res):
+        return [(uid, attrs['FLAGS']) for uid, attrs in imap.fetch_items(res)]
+
+    def gmail_regex(res):
+        items = []
+        for line in res:
+            parts = re.search(
+                r'('
+                r'UID (?P<uid>\d+)'
+                r' ?|'
+                r'FLAGS \((?P<flags>[^)]*)\)'
+                r' ?|'
+                r'X-GM-LABELS \((?P<labels>.*)\)'
+                r' ?|'
+                r'X-GM-MSGID (?P<msgid>\d+)'
+                r' ?|'
+                r'MODSEQ \(\d+\)'
+                r' ?){5}',
+                line.decode()
+            ).groupdict()
+            items.append((parts['uid'], parts['flags'], parts['labels']))
+        return items
+
+    def gmail_parser(res):
+        return [
+            (uid, attrs['FLAGS'], attrs['X-GM-LABELS'])
+            for uid, attrs in imap.fetch_items(res)
+        ]
+
+    cases = (
+        (
+            'UID FLAGS',
+            b'%d (UID %d FLAGS (\\Seen #tag %d) MODSEQ (%d))',
+            flags_regex,
+            (('fetch_flags', flags_parser), ('fetch_items', flags_items))
+        ),
+        (
+            'UID X-GM-*',
+            b'%d (X-GM-MSGID 1%d X-GM-LABELS ("\\\\Inbox" mlr/thrid/%d) '
+            b'FLAGS (\\Seen #tag) UID %d MODSEQ (%d))',
+            gmail_regex,
+            (('fetch_items', gmail_parser),)
+        ),
+    )
+    for label, line, regex, parsers in cases:
+        num = line.count(b'%d')
+        res = [line % ((i,) * num) for i in range(1, count + 1)]
+        print('## %s: %s lines like %r' % (label, count, res[0]))
+        old, old_time = timeit('regex', regex, res)
+        for name, parser in parsers:
+            new, new_time = timeit(name, parser, res)
+            assert old == new
+            print('speedup      %.1fx' % (old_time / new_time))
+
+
+def thread_parser(count):
+    import gc
+
+    from mailur import imap
+
+    def char_loop(line):
+        threads = []
+        uids = []
+        uid = ''
+        opening = 0
+        for i in line.decode():
+            if i == '(':
+                opening += 1
+            elif i == ')':
+                if uid:
+                    uids.append(uid)
+                    uid = ''
+                opening -= 1
+                if opening == 0:
+                    threads.append(uids)
+                    uids = []
+            elif i == ' ':
+                uids.append(uid)
+                uid = ''
+            else:
+                uid += i
+        return threads
+
+    def flat(uids):
+        # most threads are single messages or chains without branches
+        return b'(%d)(%d %d)' % tuple(next(uids) for i in range(3))
+
+    def wide(uids):
+        # short threads with a few replies to the first message
+        return b'(%d %d (%d)(%d)(%d))' % tuple(next(uids) for i in range(5))
+
+    def deep(uids):
+        # long chains of replies with a branch on every level
+        line = b''
+        for i in range(25):
+            line += b'%d (%d)(' % (next(uids), next(uids))
+        return b'(' + line[:-1] + b')' * 25
+
+    cases = (('flat', flat, 3), ('wide', wide, 5), ('deep', deep, 50))
+    for label, thread, size in cases:
+        uids = iter(range(1, count + 1))
+        line = b''.join(thread(uids) for i in range(count // size))
+        print('## %s: %s uids, %.1fMB' % (label, count, len(line) / 2 ** 20))
+        assert char_loop(line) == list(imap.parse_thread(line))
+        times = {}
+        for name, fn, args in (
+            ('char loop', char_loop, ()),
+            ('parse_thread', imap.parse_thread, ()),
+            ('ints=True', imap.parse_thread, (True,)),
+            ('nested=True', imap.parse_thread, (False, True)),
+        ):
+            # results of previous run shouldn't slow down garbage collector
+            gc.collect()
+            times[name] = timeit(name, fn, line, *args)[1]
+        print('speedup      %s' % ', '.join(
+            '%s %.1fx' % (name, times['char loop'] / times[name])
+            for name in list(times)[1:]
+        ))
+
+
+def append(count, size):
+    import tracemalloc
+    import types
+
+    from gevent import socket, spawn
+
+    from mailur import imap
+
+    headers = b'X-SHA256: <%s>\r\n' % (b'0' * 64)
+    bodies = [bytes([i]) * size * 2 ** 20 for i in range(count)]
+
+    def run(send):
+        src, dst = socket.socketpair()
+        con = types.SimpleNamespace(sock=src, send=src.sendall)
+
+        def drain():
+            buf = bytearray(2 ** 20)
+            while dst.recv_into(buf):
+                pass
+
+        reader = spawn(drain)
+        tracemalloc.start()
+        for body in bodies:
+            send(con, body)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        src.close()
+        reader.join()
+        dst.close()
+        return peak
+
+    def concat(con, body):
+        con.send(headers + body)
+
+    def sendmsg(con, body):
+        imap._sendmsg(con, (headers, body))
+
+    total = count * size
+    print('## %s messages of %sMB' % (count, size))
+    for label, fn in (('concat', concat), ('sendmsg', sendmsg)):
+        peak, duration = timeit(label, run, fn)
+        print(
+            '%-12s %.0fMB/s, peak memory: %.1fMB'
+            % ('', total / duration, peak / 2 ** 20)
+        )
+
+
+def fetch_body(count, size):
+    import functools as ft
+    import imaplib
+
+    from gevent import socket, spawn
+
+    from mailur import imap
+
+    body = b'x' * (size * 2 ** 10 - 2) + b'\r\n'
+    fetch = b''.join(
+        b'* %d FETCH (UID %d BODY[] {%d}\r\n%s)\r\n'
+        % (i, i, len(body), body)
+        for i in range(1, count + 1)
+    )
+
+    def server(sock):
+        # enough to connect and to answer one UID FETCH
+        sock.sendall(b'* OK ready\r\n')
+        for line in sock.makefile('rb'):
+            tag, cmd = line.split()[:2]
+            if cmd == b'CAPABILITY':
+                sock.sendall(b'* CAPABILITY IMAP4rev1\r\n')
+            elif cmd == b'UID':
+                sock.sendall(fetch)
+            sock.sendall(tag + b' OK done\r\n')
+        sock.close()
+
+    class Bench(imaplib.IMAP4):
+        def _create_socket(self, timeout):
+            src, dst = socket.socketpair()
+            spawn(server, dst)
+            return src
+
+    def run(parser):
+        con = Bench()
+        con.state = 'SELECTED'
+        if parser:
+            con._get_response = ft.partial(parser, con)
+        res = imap.check(con.uid('FETCH', '1:*', '(BODY.PEEK[])'))
+        con.shutdown()
+        return len(res)
+
+    total = count * size / 2 ** 10
+    print('## %s messages of %sKB' % (count, size))
+    parsers = (('imaplib', None), ('get_response', imap.get_response))
+    for label, parser in parsers:
+        duration = timeit(label, run, parser)[1]
+        print('%-12s %.0fMB/s' % ('', total / duration))
+
+
+def metadata(count, addrs):
+    import gc
+    import random
+
+    from mailur import json, pack
+
+    random.seed(count)
+    addrs = [
+        {
+            'addr': 'user%s@example.com' % i,
+            'name': 'User %s' % i,
+            'title': '"User %s" <user%s@example.com>' % (i, i),
+            'hash': '%032x' % random.getrandbits(128),
+        } for i in range(addrs)
+    ]
+
+    def msgid():
+        return '<%x@mail.example.com>' % random.getrandbits(64)
+
+    # like "data_msgs" value, most messages are replies
+    msgs = {}
+    for i in range(1, count + 1):
+        msgs[str(i)] = {
+            'arrived': 1500000000 + i * 60,
+            'msgid': msgid(),
+            'origin_uid': str(i),
+            'from': random.choice(addrs),
+            'parent': msgid() if i % 3 else None,
+        }
+
+    print('## %s messages from %s addresses' % (count, len(addrs)))
+    blobs = {}
+    for label, fn in (
+        ('json', lambda: json.dumps(msgs, sort_keys=True).encode()),
+        ('pack', lambda: pack.dumps(msgs)),
+    ):
+        blobs[label] = timeit('%s dumps' % label, fn)[0]
+        print('%-12s %.1fMB' % ('', len(blobs[label]) / 2 ** 20))
+
+    times = {}
+    for label, fn in (('json', json.loads), ('pack', pack.loads)):
+        gc.collect()
+        data = blobs[label]
+        if label == 'json':
+            data = data.decode()
+        value, times[label] = timeit('%s loads' % label, fn, data)
+        assert value == msgs
+    print('speedup      %.1fx' % (times['json'] / times['pack']))
+
+
+if __name__ == '__main__':
+    main()
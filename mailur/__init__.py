@@ -21,6 +21,25 @@ conf = {
     'USE_PROXY': os.environ.get('MLR_USE_PROXY', False),
     'IMAP_OFF': os.environ.get('MLR_IMAP_OFF', '').split(),
     'GMAIL_TWO_WAY_SYNC': os.environ.get('MLR_GMAIL_TWO_WAY_SYNC', False),
+    'IMAP_POOL_SIZE': int(os.environ.get('MLR_IMAP_POOL_SIZE', 100)),
+    'IMAP_POOL_TTL': int(os.environ.get('MLR_IMAP_POOL_TTL', 300)),
+    'IMAP_APPEND_LIMIT': int(
+        os.environ.get('MLR_IMAP_APPEND_LIMIT', 32 * 2 ** 20)
+    ),
+    'CACHE_MAX': int(os.environ.get('MLR_CACHE_MAX', 2 ** 30)),
+    'CACHE_USER_MAX': int(os.environ.get('MLR_CACHE_USER_MAX', 2 ** 29)),
+    'CACHE_DIR': os.environ.get(
+        'MLR_CACHE_DIR', os.path.expanduser('~/.cache/mailur')
+    ),
+    'METADATA_LOG': int(os.environ.get('MLR_METADATA_LOG', 50)),
+    'IMAP_FOLDERS_TTL': int(os.environ.get('MLR_IMAP_FOLDERS_TTL', 600)),
+    'IMAP_BATCH_MIN': int(os.environ.get('MLR_IMAP_BATCH_MIN', 100)),
+    'IMAP_BATCH_MAX': int(os.environ.get('MLR_IMAP_BATCH_MAX', 20000)),
+    'IMAP_THREADS_MAX': int(os.environ.get('MLR_IMAP_THREADS_MAX', 8)),
+    'IMAP_BATCH_SECONDS': int(os.environ.get('MLR_IMAP_BATCH_SECONDS', 10)),
+    'IMAP_BATCH_SIZE': int(
+        os.environ.get('MLR_IMAP_BATCH_SIZE', 64 * 2 ** 20)
+    ),
 }
 
 
@@ -1,6 +1,26 @@
-from . import conf
+import builtins
+import hashlib
+import os
+import pathlib
+import sqlite3
+import sys
+from collections import Counter, OrderedDict
+from itertools import islice
 
-store = {}
+from gevent.threadpool import ThreadPool
+
+from . import conf, log
+
+# values keyed by (user, name), least recently used go first
+store = OrderedDict()
+# approximate sizes in bytes of values and of all values of each user
+sizes = {}
+users = Counter()
+# "hits", "misses" and "evictions" keyed by (user, counter)
+stats = Counter()
+# SQLite connections keyed by (pid, user) and threads for them by pid
+disks = {}
+disk_pools = {}
 
 
 def key(name):
@@ -8,22 +28,219 @@ def key(name):
 
 
 def get(name, default=None):
-    return store.get(key(name), default)
+    k = key(name)
+    if k not in store:
+        stats[k[0], 'misses'] += 1
+        return default
+
+    stats[k[0], 'hits'] += 1
+    store.move_to_end(k)
+    return store[k]
 
 
-def set(name, value):
-    store[key(name)] = value
+def set(name, value, size=None):
+    """Save value, least recently used ones are evicted if needed
+
+    There are limits for each user "CACHE_USER_MAX" and for all users
+    "CACHE_MAX" in bytes, the size of value is estimated by "sizeof".
+    """
+    k = key(name)
+    drop(k)
+    size = sizeof(value) if size is None else size
+    store[k] = value
+    sizes[k] = size
+    users[k[0]] += size
+    evict(keep=k)
 
 
 def rm(name):
-    store.pop(key(name), None)
+    drop(key(name))
 
 
 def clear():
     for key in list(store.keys()):
         if key[0] == conf['USER']:
-            del store[key]
+            drop(key)
 
 
 def exists(name):
     return key(name) in store
+
+
+def drop(key):
+    if key not in store:
+        return
+    del store[key]
+    users[key[0]] -= sizes.pop(key)
+    if not users[key[0]]:
+        del users[key[0]]
+
+
+def evict(keep=None):
+    total = sum(users.values())
+    for k in list(store):
+        user_over = users[k[0]] > conf['CACHE_USER_MAX']
+        if total <= conf['CACHE_MAX'] and not user_over:
+            continue
+        elif k == keep:
+            # the latest value is kept even if it's too big
+            continue
+        total -= sizes[k]
+        drop(k)
+        stats[k[0], 'evictions'] += 1
+        log.debug('cache: evicted %r', k)
+
+
+def sizeof(value, sample=8, depth=4):
+    """Approximate size of value in bytes, big containers are sampled"""
+    size = sys.getsizeof(value)
+    if not depth:
+        return size
+
+    if isinstance(value, dict):
+        items = list(islice(value.items(), sample))
+        part = sum(
+            sizeof(k, sample, depth - 1) + sizeof(v, sample, depth - 1)
+            for k, v in items
+        )
+    elif isinstance(value, (list, tuple, builtins.set, frozenset)):
+        items = list(islice(value, sample))
+        part = sum(sizeof(i, sample, depth - 1) for i in items)
+    else:
+        return size
+    if items:
+        size += part * len(value) // len(items)
+    return size
+
+
+def snapshot(user=None):
+    """Counters and sizes of all users or only of given one"""
+    res = {'hits': 0, 'misses': 0, 'evictions': 0}
+    for (name, counter), value in stats.items():
+        if user is None or name == user:
+            res[counter] += value
+    res.update(
+        size=sum(users.values()) if user is None else users.get(user, 0),
+        entries=sum(1 for k in store if user is None or k[0] == user),
+    )
+    return res
+
+
+def disk_run(fn, *args):
+    """Call "fn(db, *args)" with SQLite database of the current user
+
+    SQLite calls are blocking, so they are done in one thread per process
+    and the hub isn't blocked. Errors are logged and None is returned.
+    """
+    if not conf['CACHE_DIR']:
+        return None
+
+    pid = os.getpid()
+    pool = disk_pools.get(pid)
+    if pool is None:
+        pool = disk_pools[pid] = ThreadPool(1)
+    return pool.apply(_disk_call, (conf['USER'], fn, args))
+
+
+def _disk_call(user, fn, args):
+    try:
+        return fn(_disk(user), *args)
+    except (sqlite3.Error, OSError) as e:
+        log.error('cache.%s: %r', fn.__name__, e)
+
+
+def _private(path):
+    info = path.stat()
+    if info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise PermissionError(
+            '%s must be owned by uid=%s and not accessible by others'
+            % (path, os.getuid())
+        )
+
+
+def _disk(user):
+    """SQLite database of the user shared by all processes
+
+    WAL journal is used, so readers aren't blocked by a writer. The
+    directory and files must be private, nobody else can read or plant
+    values there.
+    """
+    key = os.getpid(), user
+    db = disks.get(key)
+    if db:
+        return db
+
+    path = pathlib.Path(conf['CACHE_DIR'])
+    path.mkdir(mode=0o700, parents=True, exist_ok=True)
+    _private(path)
+    path /= '%s.sqlite' % hashlib.md5(user.encode()).hexdigest()
+    os.close(os.open(str(path), os.O_RDWR | os.O_CREAT, 0o600))
+    _private(path)
+
+    db = sqlite3.connect(str(path), timeout=5, check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.execute('''
+    CREATE TABLE IF NOT EXISTS sys (
+        uidvalidity TEXT,
+        uid INTEGER,
+        checksum INTEGER,
+        data BLOB,
+        PRIMARY KEY (uidvalidity, uid)
+    )
+    ''')
+    disks[key] = db
+    return db
+
+
+def disk_get(uidvalidity, uids):
+    """Saved {uid: (data, checksum)} of messages from "mlr/Sys"
+
+    A message is never changed, so its uid is enough as a key.
+    """
+    def get(db, uids):
+        found = {}
+        for i in range(0, len(uids), 500):
+            few = uids[i:i + 500]
+            res = db.execute(
+                'SELECT uid, data, checksum FROM sys'
+                ' WHERE uidvalidity = ? AND uid IN (%s)'
+                % ','.join('?' * len(few)),
+                [uidvalidity] + few
+            )
+            found.update((str(uid), (data, c)) for uid, data, c in res)
+        return found
+
+    if not uids:
+        return {}
+    return disk_run(get, [int(i) for i in uids]) or {}
+
+
+def disk_set(uidvalidity, items):
+    def save(db, rows):
+        with db:
+            db.executemany(
+                'INSERT OR REPLACE INTO sys VALUES (?, ?, ?, ?)', rows
+            )
+
+    if not items:
+        return
+    disk_run(save, [
+        (uidvalidity, int(uid), checksum, data)
+        for uid, (data, checksum) in items.items()
+    ])
+
+
+def disk_clean(uidvalidity, uids):
+    """Remove messages except ones with these uids"""
+    def clean(db, uids):
+        with db:
+            db.execute('DELETE FROM sys WHERE uidvalidity != ?', [uidvalidity])
+            db.execute('CREATE TEMP TABLE IF NOT EXISTS live (uid INTEGER)')
+            db.execute('DELETE FROM live')
+            db.executemany('INSERT INTO live VALUES (?)', [(i,) for i in uids])
+            db.execute(
+                'DELETE FROM sys WHERE uid NOT IN (SELECT uid FROM live)'
+            )
+
+    disk_run(clean, [int(i) for i in uids])
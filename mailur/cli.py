@@ -56,13 +56,13 @@ def build_parser(args):
         .arg('--tag')\
         .arg('--box')\
         .arg('--parse', action='store_true')\
-        .arg('--batch', type=int, default=1000, help='batch size')\
-        .arg('--threads', type=int, default=2, help='thread pool size')
+        .arg('--batch', type=int, default=1000, help='initial batch size')\
+        .arg('--threads', type=int, default=2, help='initial threads')
 
     cmd('parse')\
         .arg('criteria', nargs='?')\
-        .arg('--batch', type=int, default=1000, help='batch size')\
-        .arg('--threads', type=int, default=2, help='thread pool size')\
+        .arg('--batch', type=int, default=1000, help='initial batch size')\
+        .arg('--threads', type=int, default=2, help='initial threads')\
         .arg('--fix-duplicates', action='store_true')
 
     cmd('metadata')\
@@ -136,16 +136,16 @@ def run_forever(fn):
 
 def sync(timeout=1200):
     @run_forever
-    def idle_remote(params):
-        with remote.client(**params) as c:
-            handlers = {
-                'EXISTS': lambda res: remote.sync(),
-                'FETCH': lambda res: remote.sync(only_flags=True),
-            }
-            c.idle(handlers, timeout=timeout)
+    def watch_remote(folders):
+        handlers = {
+            'EXISTS': lambda res: remote.sync(),
+            'FETCH': lambda res: remote.sync(only_flags=True),
+        }
+        remote.watch(folders, handlers, timeout=timeout)
 
     @run_forever
     def sync_flags():
+        local.sync_vanished()
         local.sync_flags_to_all()
         local.sync_flags(
             post_handler=lambda res: remote.sync(only_flags=True),
@@ -155,8 +155,9 @@ def sync(timeout=1200):
     try:
         remote.sync()
         jobs = [spawn(sync_flags)]
-        for params in remote.get_folders():
-            jobs.append(spawn(idle_remote, params))
+        folders = remote.get_folders()
+        if folders:
+            jobs.append(spawn(watch_remote, folders))
         joinall(jobs, raise_error=True)
     except KeyboardInterrupt:
         time.sleep(1)
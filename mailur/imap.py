@@ -1,19 +1,42 @@
 import functools as ft
+import gc
 import inspect
 import json
 import re
 import time
+import zlib
+from array import array
+from bisect import bisect_left
+from collections import Counter, OrderedDict, deque
 from contextlib import contextmanager
-from imaplib import CRLF, Time2Internaldate
+from imaplib import CRLF, Continuation, Response_code, Time2Internaldate
+from itertools import accumulate, count
 
-from gevent import Timeout
+from gevent import Timeout, getcurrent, joinall, killall, sleep, spawn, wait
 from gevent.lock import RLock
 from gevent.pool import Pool
 
 from . import conf, fn_desc, fn_time, log
 
 commands = {}
-pool = {}
+# selection state is reused while epoch of the user isn't changed,
+# it is changed by each modification and by a caller (web request, etc.),
+# changes from other processes are checked by NOOP, see "select"
+epochs = {}
+stats = Counter()
+# bytes read by registered greenlets, see "Uids.call_async"
+received = {}
+# LIST results keyed by (host, username), see "list_folders"
+folders = {}
+# per command metrics keyed by (user, box, command), see "cmd_metrics",
+# the oldest keys are dropped over "metrics_limit"
+metrics = {}
+metrics_limit = 1000
+# upper bounds of latency histogram in seconds
+latency_buckets = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, float('inf'))
+throttled_re = re.compile(
+    r'THROTTLED|UNAVAILABLE|Too many simultaneous|exceeded', re.I
+)
 
 
 class Error(Exception):
@@ -21,6 +44,105 @@ class Error(Exception):
         return '%s.%s: %s' % (__name__, self.__class__.__name__, self.args)
 
 
+class Connections:
+    """Long-lived connections keyed by (user, client, box)
+
+    Least recently used connections are logged out if there are more than
+    "size" of them or if they weren't used for "ttl" seconds, but not while
+    another greenlet holds their lock. Connection which server wasn't
+    heard from for "check" seconds is checked by NOOP before reuse.
+    """
+    def __init__(self, size, ttl, check=30):
+        self.size = size
+        self.ttl = ttl
+        self.check = check
+        self.items = OrderedDict()
+        self.used = {}
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def keys(self):
+        return list(self.items.keys())
+
+    def get(self, key, create):
+        self.expire()
+        con = self.items.get(key)
+        if con is not None and con.broken:
+            log.error('%s is broken', con)
+            self.pop(key)
+            con = None
+        elif con is not None and time.time() - con.responded > self.check:
+            try:
+                con.noop()
+            except (Error, con.abort, OSError) as e:
+                log.error('%s is dead: %r', con, e)
+                self.pop(key)
+                con = None
+
+        if con is None:
+            con = create()
+            existing = self.items.get(key)
+            if existing is not None:
+                # another greenlet was faster
+                con.logout()
+                con = existing
+
+        self.items[key] = con
+        self.items.move_to_end(key)
+        self.used[key] = time.time()
+        self.shrink()
+        return con
+
+    def pop(self, key):
+        self.used.pop(key, None)
+        con = self.items.pop(key, None)
+        if con is not None:
+            con.logout()
+        return con
+
+    def drop(self, key, reason):
+        """Log out connection unless it's used by another greenlet"""
+        con = self.items[key]
+        if not con.lock.acquire(blocking=False):
+            log.debug('busy connection: %s', con)
+            return False
+
+        try:
+            log.debug('%s connection: %s', reason, con)
+            self.pop(key)
+        finally:
+            con.lock.release()
+        return True
+
+    def expire(self):
+        if not self.ttl:
+            return
+
+        deadline = time.time() - self.ttl
+        for key in self.keys():
+            if self.used[key] > deadline:
+                # the rest is used more recently
+                break
+            self.drop(key, 'expired')
+
+    def shrink(self):
+        extra = len(self.items) - self.size
+        if extra <= 0:
+            return
+
+        for key in self.keys():
+            if extra <= 0:
+                break
+            extra -= self.drop(key, 'evicted')
+
+
+pool = Connections(conf['IMAP_POOL_SIZE'], conf['IMAP_POOL_TTL'])
+
+
 def using(client, box, readonly=True, name='con', reuse=True):
     @contextmanager
     def use_or_create(kw):
@@ -30,18 +152,17 @@ def using(client, box, readonly=True, name='con', reuse=True):
 
         if reuse:
             key = conf['USER'], client, box
-            if key not in pool:
-                pool[key] = client(None)
-            con = pool[key]
+            con = pool.get(key, lambda: client(None))
             if box:
                 try:
-                    con.select(box, readonly)
-                except con.abort as e:
-                    # probably connection is already expired
-                    # try to create new one
+                    con.select(box, readonly, cached=True)
+                except (Error, OSError) as e:
+                    if not con.broken:
+                        raise
+                    # probably connection is closed by the server,
+                    # it's replaced by "pool.get" once
                     log.error(e)
-                    pool[key] = client(None)
-                    con = pool[key]
+                    con = pool.get(key, lambda: client(None))
                     con.select(box, readonly)
             if name:
                 kw[name] = con
@@ -72,12 +193,16 @@ def clean_pool(user=None):
     if user is None:
         user = conf['USER']
 
-    for key in list(pool.keys()):
+    for key in pool.keys():
         if key[0] != user:
             continue
-        con = pool.pop(key, None)
-        if con:
-            con.logout()
+        pool.pop(key)
+
+
+def touch(user=None):
+    if user is None:
+        user = conf['USER']
+    epochs[user] = epochs.get(user, 0) + 1
 
 
 def cmd_locked(func):
@@ -88,6 +213,94 @@ def cmd_locked(func):
     return inner
 
 
+def cmd_metrics(func):
+    """Record calls, traffic and latency of the command in "metrics"
+
+    "server" is time spent on reading and sending, "client" is the rest,
+    i.e. parsing responses. Nested commands are included in the outer.
+    Generators are measured only inside of their steps, so time of
+    the consumer between items isn't counted.
+    """
+    def record(con, elapsed, diff, failed):
+        key = conf['USER'], con.current_box, func.name
+        item = metrics.get(key)
+        if item is None:
+            while len(metrics) >= metrics_limit:
+                metrics.pop(next(iter(metrics)), None)
+            item = metrics[key] = {
+                'calls': 0, 'errors': 0, 'sent': 0, 'received': 0,
+                'server': 0.0, 'client': 0.0,
+                'latency': [0] * len(latency_buckets),
+            }
+        item['calls'] += 1
+        item['errors'] += failed
+        item['sent'] += diff['sent']
+        item['received'] += diff['received']
+        item['server'] += diff['wait']
+        item['client'] += max(elapsed - diff['wait'], 0)
+        item['latency'][bisect_left(latency_buckets, elapsed)] += 1
+
+    def inner_fn(con, *a, **kw):
+        traffic = getattr(con, 'traffic', Counter())
+        before = traffic.copy()
+        start = time.time()
+        failed = True
+        try:
+            res = func(con, *a, **kw)
+            failed = False
+            return res
+        finally:
+            record(con, time.time() - start, traffic - before, failed)
+
+    def inner_gen(con, *a, **kw):
+        traffic = getattr(con, 'traffic', Counter())
+        elapsed = 0.0
+        diff = Counter()
+        failed = True
+        items = func(con, *a, **kw)
+        try:
+            while True:
+                before = traffic.copy()
+                start = time.time()
+                try:
+                    item = next(items)
+                except StopIteration as e:
+                    failed = False
+                    return e.value
+                finally:
+                    elapsed += time.time() - start
+                    diff += traffic - before
+                yield item
+        except GeneratorExit:
+            # closed by the consumer, not an error
+            failed = False
+            raise
+        finally:
+            items.close()
+            record(con, elapsed, diff, failed)
+
+    inner = inner_gen if inspect.isgeneratorfunction(func) else inner_fn
+    return ft.wraps(func)(inner)
+
+
+def metrics_snapshot(user=None, reset=False):
+    """Copy of command metrics, only for one user if it's given
+
+    Keys are (user, box, command), values are dicts with "calls",
+    "errors", "sent" and "received" bytes, "server" and "client" seconds
+    and "latency" histogram with counts for each of "latency_buckets".
+    Only the latest "metrics_limit" keys are kept.
+    """
+    res = {}
+    for key, item in list(metrics.items()):
+        if user is not None and key[0] != user:
+            continue
+        res[key] = dict(item, latency=list(item['latency']))
+        if reset:
+            metrics.pop(key, None)
+    return res
+
+
 def cmd_writable(func):
     @ft.wraps(func)
     def inner(con, *a, **kw):
@@ -97,16 +310,37 @@ def cmd_writable(func):
     return inner
 
 
+def cmd_changes(func):
+    @ft.wraps(func)
+    def inner(con, *a, **kw):
+        res = func(con, *a, **kw)
+        touch()
+        return res
+    return inner
+
+
 def cmd_error(func):
     @ft.wraps(func)
     def inner(con, *a, **kw):
         try:
             return func(con, *a, **kw)
+        except (con.abort, OSError) as e:
+            # failed on the socket level, so the connection can't be reused
+            con.broken = True
+            if isinstance(e, OSError):
+                raise
+            raise Error(e)
         except con.error as e:
             raise Error(e)
     return inner
 
 
+def shutdown(con):
+    """Close the socket, when the state of a command is unknown"""
+    con.broken = True
+    con.shutdown()
+
+
 def check(res):
     typ, data = res
     if typ != 'OK':
@@ -114,17 +348,25 @@ def check(res):
     return data
 
 
-def command(*, name=None, lock=True, writable=False, dovecot=False):
+def command(
+    *, name=None, lock=True, writable=False, dovecot=False, changes=None
+):
+    if changes is None:
+        changes = writable
+
     def inner(func):
         if name:
             func.name = name
         else:
             func.name = func.__name__
 
+        func = cmd_metrics(func)
         if lock:
             func = cmd_locked(func)
 
         func = cmd_error(func)
+        if changes:
+            func = cmd_changes(func)
         commands[func] = {'writable': writable, 'dovecot': dovecot}
         return func
     return inner
@@ -134,6 +376,9 @@ class Conn:
     def defaults(self):
         self.current_box = None
         self.flags = None
+        self.epoch = None
+        self.selected = None
+        self.vanished = []
 
     def __repr__(self):
         return str(self)
@@ -144,6 +389,76 @@ class Conn:
         )
 
 
+class Deflate:
+    """Socket and file of connection with COMPRESS=DEFLATE (RFC 4978)
+
+    It replaces both "con.sock" and "con.file", so imaplib is working
+    with it as usual. Each write is flushed with Z_SYNC_FLUSH, so the
+    server gets the whole command right away.
+    """
+    chunk = 2 ** 16
+
+    def __init__(self, sock, file):
+        self.sock = sock
+        self.file = file
+        self.deflate = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS
+        )
+        self.inflate = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.buf = bytearray()
+
+    def sendall(self, data):
+        data = self.deflate.compress(data)
+        data += self.deflate.flush(zlib.Z_SYNC_FLUSH)
+        self.sock.sendall(data)
+
+    def _fill(self):
+        while True:
+            data = self.file.read1(self.chunk)
+            if not data:
+                return False
+            data = self.inflate.decompress(data)
+            if data:
+                self.buf += data
+                return True
+
+    def read(self, size):
+        while len(self.buf) < size and self._fill():
+            pass
+        return self._take(size)
+
+    def readline(self, limit=-1):
+        start = 0
+        while True:
+            end = self.buf.find(b'\n', start) + 1
+            if end or 0 <= limit <= len(self.buf):
+                break
+            start = len(self.buf)
+            if not self._fill():
+                end = len(self.buf)
+                break
+        if 0 <= limit < end or not end:
+            end = limit if limit >= 0 else len(self.buf)
+        return self._take(end)
+
+    def _take(self, size):
+        # copied once, slice of "bytearray" would be one more copy
+        with memoryview(self.buf) as view, view[:size] as head:
+            data = bytes(head)
+        del self.buf[:size]
+        return data
+
+    def shutdown(self, how):
+        # imaplib calls "file.close", "sock.shutdown", "sock.close"
+        try:
+            self.sock.shutdown(how)
+        finally:
+            self.sock.close()
+
+    def close(self):
+        self.file.close()
+
+
 class Ctx:
     def __init__(self, con):
         self._con = con
@@ -166,6 +481,18 @@ class Ctx:
     def is_readonly(self):
         return self._con.is_readonly
 
+    @property
+    def lock(self):
+        return self._con.lock
+
+    @property
+    def broken(self):
+        return self._con.broken
+
+    @property
+    def responded(self):
+        return self._con.responded
+
     @property
     def abort(self):
         return self._con.abort
@@ -190,6 +517,10 @@ class Ctx:
     def highestmodseq(self):
         return self._con.highestmodseq
 
+    @property
+    def vanished(self):
+        return self._con.vanished
+
     def __enter__(self):
         return self
 
@@ -202,7 +533,11 @@ def client(connect, *, writable=False, dovecot=False, debug=None):
         con = connect()
         con.debug = conf['DEBUG_IMAP'] if debug is None else debug
         con.lock = RLock()
+        con.broken = False
+        con.responded = time.time()
         con.new = new
+        count_traffic(con)
+        con._get_response = ft.partial(get_response, con)
         return con
 
     def new():
@@ -224,12 +559,133 @@ def client(connect, *, writable=False, dovecot=False, debug=None):
     return ctx
 
 
+untagged_re = re.compile(br'\* (?:(\d+) )?([A-Z-]+)(?: (.*))?', re.ASCII)
+literal_re = re.compile(br'\{(\d+)\}$', re.ASCII)
+
+
+def get_response(con):
+    """Read and store one response, replaces "imaplib.IMAP4._get_response"
+
+    Responses are stored the same way, but each line is matched by one
+    compiled regex instead of up to four and it isn't logged with repr.
+    """
+    def get_line():
+        line = con.readline()
+        if not line:
+            raise con.abort('socket error: EOF')
+        if line[-2:] != CRLF:
+            raise con.abort('socket error: unterminated line: %r' % line)
+        if con.debug >= 4:
+            con._mesg('< %r' % line)
+        return line[:-2]
+
+    def append(typ, dat):
+        if dat is None:
+            dat = b''
+        found = responses.get(typ)
+        if found is None:
+            responses[typ] = [dat]
+        else:
+            found.append(dat)
+
+    responses = con.untagged_responses
+    resp = get_line()
+    first = resp[:1]
+    if first == b'*':
+        found = untagged_re.match(resp)
+        if not found:
+            raise con.abort('unexpected response: %r' % resp)
+        num, typ, dat = found.groups()
+        typ = typ.decode()
+        if num:
+            # like "* 5 EXISTS" or "* 1 FETCH (...)"
+            dat = num + b' ' + dat if dat else num
+        elif dat is None:
+            dat = b''
+        while dat[-1:] == b'}':
+            found = literal_re.search(dat)
+            if not found:
+                break
+            append(typ, (dat, con.read(int(found.group(1)))))
+            dat = get_line()
+        append(typ, dat)
+    elif first == b'+':
+        con.continuation_response = Continuation.match(resp).group('data')
+        return None
+    else:
+        found = con.tagre.match(resp)
+        if not found:
+            raise con.abort('unexpected response: %r' % resp)
+        tag = found.group('tag')
+        if tag not in con.tagged_commands:
+            raise con.abort('unexpected tagged response: %r' % resp)
+        typ = found.group('type').decode()
+        dat = found.group('data')
+        con.tagged_commands[tag] = (typ, [dat])
+        con.responded = time.time()
+
+    if typ in ('OK', 'NO', 'BAD'):
+        found = Response_code.match(dat)
+        if found:
+            append(found.group('type').decode(), found.group('data'))
+    return resp
+
+
+def count_traffic(con):
+    def counted(func):
+        def inner(*a):
+            start = time.time()
+            data = func(*a)
+            con.traffic['wait'] += time.time() - start
+            con.traffic['received'] += len(data)
+            current = getcurrent()
+            if current in received:
+                received[current] += len(data)
+            return data
+        return inner
+
+    def counted_send(func):
+        def inner(data):
+            start = time.time()
+            func(data)
+            con.traffic['wait'] += time.time() - start
+            con.traffic['sent'] += len(data)
+        return inner
+
+    con.traffic = Counter()
+    # imaplib reads everything with these two
+    con.read = counted(con.read)
+    con.readline = counted(con.readline)
+    con.send = counted_send(con.send)
+
+
 def login(con, username, password):
     try:
-        return check(con.login(username, password))
+        res = check(con.login(username, password))
     except con.error as e:
         raise Error(e)
 
+    # capabilities are usually extended after login
+    caps = re.match(br'\[CAPABILITY ([^\]]+)\]', res[0] or b'')
+    if caps:
+        caps = caps.group(1)
+    else:
+        caps = check(con.capability())[-1]
+    con.capabilities = tuple(caps.decode().upper().split())
+    return res
+
+
+def compress(con):
+    """Enable COMPRESS=DEFLATE if it's supported by the server"""
+    if 'COMPRESS=DEFLATE' not in con.capabilities:
+        return False
+
+    with _cmd(con, 'COMPRESS') as (tag, start, complete):
+        start(b' DEFLATE' + CRLF)
+        check(complete())
+    con.sock = con.file = Deflate(con.sock, con.file)
+    return True
+
 
 @contextmanager
 def _cmd(con, name):
@@ -268,7 +724,7 @@ def getmetadata(con, box, key):
         return check(con._untagged_response(typ, data, 'METADATA'))
 
 
-@command(dovecot=True)
+@command(dovecot=True, changes=True)
 def sieve(con, criteria, script):
     script = script.strip().encode()
     criteria = criteria.encode()
@@ -298,23 +754,71 @@ def clean_recent(flags):
     return re.sub(r'(^| )\\Recent( |$)', ' ', flags)
 
 
+def _msg_parts(msg):
+    return [msg] if isinstance(msg, (bytes, bytearray, memoryview)) else msg
+
+
+def _sendmsg(con, parts):
+    """Send parts without joining them together
+
+    Scatter/gather write is used for plain sockets, SSL sockets don't
+    support it, so parts are sent one by one there.
+    """
+    bufs = [memoryview(i) for i in parts if len(i)]
+    sendmsg = getattr(con.sock, 'sendmsg', None)
+    traffic = getattr(con, 'traffic', Counter())
+    try:
+        while sendmsg and bufs:
+            start = time.time()
+            sent = sendmsg(bufs)
+            traffic['wait'] += time.time() - start
+            traffic['sent'] += sent
+            while bufs and sent >= len(bufs[0]):
+                sent -= len(bufs.pop(0))
+            if sent:
+                bufs[0] = bufs[0][sent:]
+    except NotImplementedError:
+        pass
+    for i in bufs:
+        con.send(i)
+
+
 def _multiappend(con, box, msgs):
+    """Append messages with one MULTIAPPEND command (RFC 3502)
+
+    Message can be bytes or a sequence of parts, like (headers, body),
+    parts are sent as they are without copying into one bytes object.
+    """
+    # with non-synchronizing literals (RFC 7888) there is no need
+    # to wait for continuation response before each message
+    literal_plus = 'LITERAL+' in con.capabilities
+    literal = '{%s+}' if literal_plus else '{%s}'
     with _cmd(con, 'APPEND') as (tag, start, complete):
         send = start
-        for date_time, flags, msg in msgs:
-            flags = clean_recent(flags)
-            if date_time is None:
-                date_time = Time2Internaldate(time.time())
-            args = (' (%s) %s %s' % (flags, date_time, '{%s}' % len(msg)))
-            if send == start:
-                args = ' %s %s' % (box, args)
-            send(args.encode() + CRLF)
-            send = con.send
-            while con._get_response():
-                bad = con.tagged_commands[tag]
-                if bad:
-                    raise Error(bad)
-            con.send(msg)
+        try:
+            for date_time, flags, msg in msgs:
+                parts = _msg_parts(msg)
+                flags = clean_recent(flags)
+                if date_time is None:
+                    date_time = Time2Internaldate(time.time())
+                size = sum(len(i) for i in parts)
+                args = ' (%s) %s %s' % (flags, date_time, literal % size)
+                if send == start:
+                    args = ' %s %s' % (box, args)
+                send(args.encode() + CRLF)
+                send = con.send
+                while not literal_plus and con._get_response():
+                    bad = con.tagged_commands[tag]
+                    if bad:
+                        raise Error(bad)
+                _sendmsg(con, parts)
+        except Exception:
+            if send != start:
+                # after NO/BAD or a partially sent literal the state of
+                # the command is unknown, so the connection is dropped
+                # (MULTIAPPEND is atomic, nothing is appended, RFC 3502)
+                shutdown(con)
+            raise
         con.send(CRLF)
         res = check(complete())
         log.debug('%s', res[0].decode())
@@ -323,8 +827,43 @@ def _multiappend(con, box, msgs):
         return uids
 
 
+def _multiappend_iter(con, box, msgs, limit, batch=None):
+    msgs = iter(msgs)
+    pending = next(msgs, None)
+
+    def few():
+        nonlocal pending
+        size = count = 0
+        while pending is not None:
+            yield pending
+            size += sum(len(i) for i in _msg_parts(pending[2]))
+            count += 1
+            # look ahead only after the message is sent
+            pending = next(msgs, None)
+            if size >= limit or batch and count >= batch:
+                return
+
+    uids = []
+    while pending is not None:
+        res = _multiappend(con, box, few())
+        log.debug('multiappend: %s', res)
+        uids.append(res)
+    return ','.join(uids) or None
+
+
 @command(dovecot=True, writable=True, lock=False)
-def multiappend(con, box, msgs, *, batch=None, threads=10):
+def multiappend(con, box, msgs, *, batch=None, threads=10, limit=None):
+    """Append messages with one or more APPEND commands
+
+    If "msgs" is an iterator, messages are sent as soon as they are
+    produced and a new APPEND is started after "limit" bytes or "batch"
+    messages, so only one message is kept in memory at a time.
+    """
+    if not isinstance(msgs, (list, tuple)):
+        limit = limit or conf['IMAP_APPEND_LIMIT']
+        with con.lock:
+            return _multiappend_iter(con, box, msgs, limit, batch)
+
     if not msgs:
         return
 
@@ -354,20 +893,49 @@ def thread(con, *criteria):
 
 
 @command(dovecot=True)
-def sort(con, fields, *criteria, charset='UTF-8'):
-    res = check(con.uid('SORT', fields, charset, *criteria))
-    return res[0].decode().split()
-
+def sort(con, fields, *criteria, charset='UTF-8', partial=None):
+    """UID SORT, with "partial" gives (uids, count) for a page only
+
+    "partial" is (first, last) positions starting from 1. With ESORT and
+    CONTEXT=SORT (RFC 5267) only the page is returned by the server.
+    Dovecot has only ESORT, so "RETURN (ALL COUNT)" gives all uids as
+    a compact sequence set in sort order and the page is cut here, without
+    ESORT it's cut from the plain SORT response.
+    """
+    if partial is None:
+        res = check(con.uid('SORT', fields, charset, *criteria))
+        return res[0].decode().split()
+
+    first, last = partial
+    if 'ESORT' not in con.capabilities:
+        res = check(con.uid('SORT', fields, charset, *criteria))
+        uids = res[0].decode().split()
+        return uids[first - 1:last], len(uids)
+
+    key = 'PARTIAL' if 'CONTEXT=SORT' in con.capabilities else 'ALL'
+    if key == 'PARTIAL':
+        ret = 'RETURN (PARTIAL %d:%d COUNT)' % (first, last)
+    else:
+        ret = 'RETURN (ALL COUNT)'
+    con.untagged_responses.pop('ESEARCH', None)
+    check(con.uid('SORT', ret, fields, charset, *criteria))
+    res = con.untagged_responses.pop('ESEARCH', [b''])
+    res = parse_esearch(res[-1], [key, 'COUNT'])
+    uids = unpack_uids(res[key.lower()])
+    if key == 'ALL':
+        uids = uids[first - 1:last]
+    return [str(i) for i in uids], res['count']
+
+
+def _match(con, handlers):
+    for code, handler in handlers.items():
+        typ, dat = con._untagged_response('OK', [None], code)
+        if not dat[-1]:
+            continue
+        handler(dat)
 
-@command()
-def idle(con, handlers, timeout=None):
-    def match():
-        for code, handler in handlers.items():
-            typ, dat = con._untagged_response('OK', [None], code)
-            if not dat[-1]:
-                continue
-            handler(dat)
 
+def _idle(con, match, timeout):
     def inner(tag):
         with Timeout(timeout):
             res = con._get_response()
@@ -376,6 +944,8 @@ def idle(con, handlers, timeout=None):
         bad = con.tagged_commands[tag]
         if bad:
             raise Error(bad)
+        # something is changed, so selected mailboxes should be refreshed
+        touch()
         match()
 
     match()
@@ -391,6 +961,110 @@ def idle(con, handlers, timeout=None):
                 return
 
 
+@command()
+def idle(con, handlers, timeout=None):
+    _idle(con, lambda: _match(con, handlers), timeout)
+
+
+@command()
+def watch(con, handlers, timeout=None):
+    """Watch several mailboxes on one connection with NOTIFY (RFC 5465)
+
+    "handlers" is like {box: {'EXISTS': fn, 'FETCH': fn}}. The first
+    mailbox is selected, so its handlers get the same responses as with
+    IDLE. Other mailboxes are reported with STATUS responses: changed
+    UIDNEXT calls "EXISTS", fewer MESSAGES than expected with new UIDs
+    calls "VANISHED" and changed HIGHESTMODSEQ calls "FETCH" handler.
+
+    Without NOTIFY each mailbox is idling on its own connection.
+    """
+    (selected, selected_handlers), *others = handlers.items()
+    select(con, selected)
+    if 'NOTIFY' not in con.capabilities:
+        return _watch_idle(con, selected_handlers, others, timeout)
+
+    events = '(MessageNew MessageExpunge FlagChange)'
+    args = ' SET STATUS (SELECTED %s)' % events
+    if others:
+        boxes = ' '.join('"%s"' % _box_name(box) for box, _ in others)
+        args += ' (MAILBOXES (%s) %s)' % (boxes, events)
+    con.untagged_responses.pop('STATUS', None)
+    with _cmd(con, 'NOTIFY') as (tag, start, complete):
+        start(args.encode() + CRLF)
+        check(complete())
+
+    others = {_box_name(box): found for box, found in others}
+    state = {}
+
+    def match():
+        _match(con, selected_handlers)
+        for line in con.untagged_responses.pop('STATUS', []):
+            box, new = parse_status(line)
+            old = state.get(box)
+            new = state[box] = dict(old or {}, **new)
+            if old is None or box not in others:
+                # the first STATUS is sent right after NOTIFY SET
+                continue
+
+            # one STATUS can cover both new and expunged messages
+            added = new.get('UIDNEXT', 0) - old.get('UIDNEXT', 0)
+            codes = []
+            if added:
+                codes.append('EXISTS')
+            if new.get('MESSAGES', 0) < old.get('MESSAGES', 0) + added:
+                codes.append('VANISHED')
+            if new.get('HIGHESTMODSEQ') != old.get('HIGHESTMODSEQ'):
+                codes.append('FETCH')
+            for code in codes:
+                handler = others[box].get(code)
+                if handler:
+                    handler([line])
+
+    _idle(con, match, timeout)
+
+
+def _watch_idle(con, handlers, others, timeout):
+    def idle_box(box, handlers):
+        # "con.new" gives a plain connection, so module commands are used
+        c = con.new()
+        try:
+            select(c, box)
+            idle(c, handlers, timeout)
+        finally:
+            logout(c)
+
+    jobs = [spawn(idle_box, box, found) for box, found in others]
+    try:
+        idle(con, handlers, timeout)
+        joinall(jobs, raise_error=True)
+    finally:
+        killall(jobs)
+
+
+def _box_name(box):
+    if isinstance(box, bytes):
+        box = box.decode()
+    return box.strip('"')
+
+
+status_re = re.compile(r'^("[^"]*"|[^ ]+) \(([^)]*)\)')
+
+
+def parse_status(line):
+    """Parse STATUS response like '"mlr/All" (MESSAGES 5 UIDNEXT 6)'"""
+    if isinstance(line, bytes):
+        line = line.decode()
+    box, items = status_re.match(line.strip()).groups()
+    items = items.split()
+    items = {k.upper(): int(v) for k, v in zip(items[::2], items[1::2])}
+    return _box_name(box), items
+
+
+@command()
+def noop(con):
+    return check(con.noop())
+
+
 @command(lock=False)
 def enable(con, capability):
     return check(con.enable(capability))
@@ -398,10 +1072,19 @@ def enable(con, capability):
 
 @command()
 def logout(con, timeout=1):
+    if con.broken:
+        # nothing can be sent, so the socket is just closed
+        try:
+            con.shutdown()
+        except OSError as e:
+            # it can be closed already, see "shutdown"
+            log.debug(e)
+        return
+
     with Timeout(timeout):
         try:
             return con.logout()
-        except con.abort as e:
+        except (con.abort, OSError) as e:
             log.error(e)
 
 
@@ -410,24 +1093,115 @@ def xlist(con, folder='""', pattern='*'):
     return check(con.list(folder, pattern))
 
 
+# untagged responses after NOOP, which mean the mailbox is changed
+select_changes = {'EXISTS', 'RECENT', 'EXPUNGE', 'VANISHED', 'FETCH'}
+
+
 @command()
-def select(con, box, readonly=True):
-    res = check(con.select(box, readonly))
-    con.current_box = box.decode() if isinstance(box, bytes) else box
+def select(con, box, readonly=True, *, cached=False, qresync=None):
+    """Select mailbox, cached one is reused if nothing is changed
+
+    "qresync" is (uidvalidity, modseq) saved before, uids expunged since
+    then are given in "con.vanished" (RFC 7162). They are sent only if
+    UIDVALIDITY is the same, so it should be checked by a caller.
+    """
+    name = box.decode() if isinstance(box, bytes) else box
+    epoch = epochs.get(conf['USER'])
+    if (
+        cached and con.epoch == epoch and con.current_box == name
+        and con.is_readonly == bool(readonly)
+    ):
+        # the mailbox is selected in the same mode and nothing is changed
+        # by this process, but sync or CLI could change it; such updates
+        # come with responses to any command (RFC 3501, section 6.1.2),
+        # so NOOP is sent only if the server wasn't heard for a while,
+        # it's the same check as in "Connections.get"
+        if time.time() - con.responded <= pool.check:
+            if not select_changes & set(con.untagged_responses):
+                stats['select_skipped'] += 1
+                return con.selected
+        else:
+            con.untagged_responses = {}
+            typ, _ = con.noop()
+            changes = select_changes & set(con.untagged_responses)
+            if typ == 'OK' and not changes:
+                con.untagged_responses = {}
+                stats['select_noop'] += 1
+                return con.selected
+
+    stats['select'] += 1
+    if qresync:
+        res = check(_select_qresync(con, box, readonly, qresync))
+    else:
+        res = check(con.select(box, readonly))
+    vanished = con.untagged_responses.pop('VANISHED', [])
+    con.vanished = parse_vanished(vanished)
+    con.epoch = epoch
+    con.selected = res
+    con.current_box = name
     con.flags = con.untagged_responses['FLAGS'][0].decode()[1:-1].split()
     con.uidnext = int(con.untagged_responses['UIDNEXT'][0].decode())
     con.uidvalidity = con.untagged_responses['UIDVALIDITY'][0].decode()
     highestmodseq = int(con.untagged_responses['HIGHESTMODSEQ'][0].decode())
     con.highestmodseq = highestmodseq
+    # only later updates mean that the mailbox is changed
+    for i in select_changes:
+        con.untagged_responses.pop(i, None)
     return res
 
 
-@ft.lru_cache(None)
+def _select_qresync(con, box, readonly, qresync):
+    # like "imaplib.IMAP4.select", but with QRESYNC parameter
+    con.untagged_responses = {}
+    con.is_readonly = readonly
+    cmd = 'EXAMINE' if readonly else 'SELECT'
+    params = '(QRESYNC (%s %s))' % tuple(qresync)
+    typ, dat = con._simple_command(cmd, box, params)
+    if typ != 'OK':
+        con.state = 'AUTH'
+        return typ, dat
+    con.state = 'SELECTED'
+    return typ, con.untagged_responses.get('EXISTS', [None])
+
+
+def parse_vanished(lines):
+    """Parse VANISHED responses like "(EARLIER) 41,43:116" into uids"""
+    uids = array('I')
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode()
+        uids.extend(unpack_uids(line.rsplit(' ', 1)[-1]))
+    return [str(i) for i in sorted(set(uids))]
+
+
+def list_folders(con):
+    """LIST result of the account, it's reused for "IMAP_FOLDERS_TTL"
+
+    The account is (host, username), so new connections reuse it too.
+    """
+    now = time.time()
+    for key, (created, _) in list(folders.items()):
+        if now - created > conf['IMAP_FOLDERS_TTL']:
+            del folders[key]
+
+    key = con.host, con.username
+    if key not in folders:
+        folders[key] = now, xlist(con)
+    return folders[key][1]
+
+
+def clean_folders(con=None):
+    if con is None:
+        folders.clear()
+        return
+    folders.pop((con.host, con.username), None)
+
+
 def find_folder(con, tag):
     if isinstance(tag, str):
         tag = tag.encode()
     folder = None
-    folders = xlist(con)
+    folders = list_folders(con)
     for f in folders:
         if not re.search(br'^\([^)]*?%s' % re.escape(tag), f):
             continue
@@ -443,7 +1217,12 @@ def select_tag(con, tag, readonly=True, exc=True):
         if exc:
             raise Error('No folder with tag: %s\n%s' % (tag, folders))
         return None
-    return select(con, folder, readonly)
+    try:
+        return select(con, folder, readonly)
+    except Error:
+        # the folder could be renamed since LIST
+        clean_folders(con)
+        raise
 
 
 @command()
@@ -458,6 +1237,59 @@ def search(con, *criteria):
     return res[0].decode().split()
 
 
+@command()
+def esearch(con, *criteria, ret=('COUNT', 'MIN', 'MAX', 'ALL')):
+    """UID SEARCH with RETURN options from ESEARCH (RFC 4731)
+
+    Gives dict with "count", "min", "max" and "all" keys for requested
+    options, "all" is a sequence set like "1:4,7" (see "unpack_uids").
+    Plain SEARCH is used if ESEARCH isn't supported by the server.
+    """
+    ret = [i.upper() for i in ret]
+    if 'ESEARCH' not in con.capabilities:
+        res = check(con.uid('SEARCH', None, *criteria))
+        uids = sorted(set(int(i) for i in res[0].split()))
+        found = {
+            'COUNT': len(uids),
+            'MIN': uids[0] if uids else None,
+            'MAX': uids[-1] if uids else None,
+            'ALL': _pack_uids(uids),
+        }
+        return {i.lower(): found[i] for i in ret}
+
+    con.untagged_responses.pop('ESEARCH', None)
+    criteria = ('RETURN (%s)' % ' '.join(ret),) + criteria
+    check(con.uid('SEARCH', *criteria))
+    res = con.untagged_responses.pop('ESEARCH', [b''])
+    return parse_esearch(res[-1], ret)
+
+
+esearch_re = re.compile(r'^(?:\(TAG "[^"]*"\) ?)?(?:UID ?)?')
+esearch_items_re = re.compile(r'([A-Za-z]+) (\([^)]*\)|[^ ]+)')
+
+
+def parse_esearch(line, ret):
+    if isinstance(line, bytes):
+        line = line.decode()
+    items = esearch_items_re.findall(esearch_re.sub('', line.strip()))
+    found = {key.upper(): value for key, value in items}
+    res = {}
+    for key in ret:
+        value = found.get(key)
+        if key == 'COUNT':
+            value = int(value or 0)
+        elif key == 'ALL':
+            value = value or ''
+        elif key == 'PARTIAL':
+            # like "(1:200 5,3:1)" or "(1:200 NIL)"
+            value = value.strip('()').split()[-1] if value else 'NIL'
+            value = '' if value.upper() == 'NIL' else value
+        elif value is not None:
+            value = int(value)
+        res[key.lower()] = value
+    return res
+
+
 @command(writable=True)
 def append(con, box, flags, date_time, msg):
     check(con.append(box, clean_recent(flags), date_time, msg))
@@ -471,11 +1303,37 @@ def append(con, box, flags, date_time, msg):
 
 @command(writable=True)
 @cmd_writable
-def expunge(con):
-    return check(con.expunge())
+def expunge(con, uids=None):
+    """EXPUNGE all deleted messages or only given "uids"
 
+    With UID EXPUNGE (RFC 4315) deleted messages of other clients aren't
+    touched, plain EXPUNGE is used if UIDPLUS isn't supported.
+    """
+    if uids is None or 'UIDPLUS' not in con.capabilities:
+        return check(con.expunge())
 
-@command()
+    uids = Uids(uids).str
+    if not uids:
+        return []
+    return check(con.uid('EXPUNGE', uids))
+
+
+@command(writable=True)
+@cmd_writable
+def move(con, uids, box):
+    """UID MOVE (RFC 6851), without it COPY, STORE and UID EXPUNGE"""
+    uids = Uids(uids)
+    if not uids.str:
+        return []
+    elif 'MOVE' in con.capabilities:
+        return check(con.uid('MOVE', uids.str, box))
+
+    check(con.uid('COPY', uids.str, box))
+    check(con.uid('STORE', uids.str, '+FLAGS.SILENT', '\\Deleted'))
+    return expunge(con, uids)
+
+
+@command(changes=True)
 def copy(con, uids, box):
     return check(con.uid('COPY', ','.join(uids), box))
 
@@ -484,8 +1342,7 @@ def copy(con, uids, box):
 def fetch(con, uids, fields):
     uids = Uids(uids)
     if uids.batches:
-        res = uids.call_async(fetch, con, uids, fields)
-        return sum(res, [])
+        return uids.pipeline(con, 'FETCH', fields)
 
     desc = fn_desc(fetch, con, uids, fields)
     with con.lock:
@@ -495,6 +1352,52 @@ def fetch(con, uids, fields):
     return res
 
 
+@command(lock=False)
+def iter_fetch(con, uids, fields):
+    """Yield (uid, attrs) for each message as soon as it's received
+
+    The connection is locked until the generator is exhausted or closed.
+    """
+    uids = Uids(uids)
+    for few in uids.batches or [uids]:
+        desc = fn_desc(iter_fetch, con, few, fields)
+        yield from fn_time(_iter_fetch, desc)(con, few, fields)
+
+
+def _iter_fetch(con, uids, fields):
+    def receive():
+        con._get_response()
+        return con.untagged_responses.pop('FETCH', [])
+
+    def responses():
+        while not done():
+            yield from receive()
+
+    def done():
+        return con.tagged_commands.get(tag) is not None
+
+    with con.lock, _cmd(con, 'UID FETCH') as (tag, start, complete):
+        try:
+            # drop unsolicited responses received before
+            con.untagged_responses.pop('FETCH', None)
+            start(' %s %s' % (uids.str, fields) + '\r\n')
+            yield from fetch_items(responses())
+            check(complete())
+        except GeneratorExit:
+            # not interesting anymore, but the rest should be read anyway
+            while not done():
+                receive()
+            raise
+        except (con.abort, OSError) as e:
+            # like in "cmd_error", the connection can't be reused
+            con.broken = True
+            if isinstance(e, OSError):
+                raise
+            raise Error(e)
+        except con.error as e:
+            raise Error(e)
+
+
 @command(lock=False, writable=True)
 @cmd_writable
 def store(con, uids, cmd, flags):
@@ -507,8 +1410,7 @@ def store(con, uids, cmd, flags):
 
     uids = Uids(uids)
     if uids.batches:
-        res = uids.call_async(store, con, uids, cmd, flags)
-        return sum(res, [])
+        return uids.pipeline(con, 'STORE', cmd, flags)
 
     desc = fn_desc(store, con, uids, cmd, flags)
     with con.lock:
@@ -525,87 +1427,479 @@ class Threads(tuple):
         return obj
 
 
-def parse_thread(line):
+# THREAD response is turned into uids by "str.split" and into JSON
+thread_no_parens = str.maketrans('()', '  ')
+thread_as_json = str.maketrans({'(': '[', ')': ']', ' ': ','})
+
+
+def parse_thread(line, ints=False, nested=False):
+    """Parse THREAD response into list of threads
+
+    - ints=True gives array('I') of uids instead of strings
+    - nested=True keeps tree structure, each "(...)" becomes a list
+    """
     if isinstance(line, bytes):
         line = line.decode()
+    line = line.strip()
 
-    threads = []
-    all_uids = []
-    uids = []
-    uid = ''
-    opening = 0
-    for i in line:
-        if i == '(':
-            opening += 1
-        elif i == ')':
-            if uid:
-                uids.append(uid)
-                uid = ''
-
-            opening -= 1
-            if opening == 0:
-                threads.append(uids)
-                all_uids.extend(uids)
-                uids = []
-        elif i == ' ':
-            uids.append(uid)
-            uid = ''
+    # a lot of small lists are created here and nothing to collect
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _parse_thread(line, ints, nested)
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _parse_thread(line, ints, nested):
+    all_uids = line.translate(thread_no_parens).split()
+    if ints:
+        all_uids = array('I', map(int, all_uids))
+
+    if nested:
+        value = '[%s]' % line.translate(thread_as_json).replace('][', '],[')
+        threads = json.loads(value, parse_int=None if ints else str)
+        return Threads(threads, all_uids)
+
+    # uids are counted for each thread, parts split by ")(" are
+    # threads by themselves unless there are nested parens
+    sizes = []
+    size = depth = 0
+    for part in line[1:-1].split(')(') if line else ():
+        if depth or '(' in part:
+            depth += part.count('(') - part.count(')')
+            size += part.count(' ') + 1
+            if not depth:
+                sizes.append(size)
+                size = 0
         else:
-            uid += i
+            sizes.append(part.count(' ') + 1)
+    ends = list(accumulate(sizes))
+    threads = [all_uids[a:b] for a, b in zip([0] + ends, ends)]
     return Threads(threads, all_uids)
 
 
+fetch_literal_re = re.compile(
+    rb'[ (]([^ (]+(?:\[[^\]]*\])?) ~?\{\d+\}$'
+)
+# patterns of values, "fetch_re" gives a kind by the last matched group:
+# - "FLAGS (\\Seen)", "MODSEQ (1)", "X-GM-LABELS (...)": value inside parens
+# - "INTERNALDATE "..."": value inside quotes, escapes are allowed
+# - "UID 1", "X-GM-MSGID 1", "BODY[] NIL": value as is
+# only one level of nested lists is supported
+fetch_values = {
+    '(': (
+        rb'\(([^()"]*'
+        rb'(?:(?:"[^"\\]*(?:\\.[^"\\]*)*"|\([^()]*\))[^()"]*)*)\)'
+    ),
+    '"': rb'"([^"\\]*(?:\\.[^"\\]*)*)"',
+    '': rb'((?!NIL\b)[^ ()"{]+)',
+}
+fetch_kinds = {2: '(', 3: '"', 4: ''}
+fetch_re = re.compile(
+    rb'[ (]([A-Z][A-Z0-9.\-]*(?:\[[^\]]*\](?:<\d+>)?)?) (?:%s|%s|([^ ()"{]+))'
+    % (fetch_values['('], fetch_values['"'])
+)
+# the most common response: flags of many messages
+fetch_flags_line = (
+    rb'\d+ \(UID (\d+) FLAGS \(([^()"]*)\)(?: MODSEQ \((\d+)\))?\)'
+)
+# "fetch_flags" looks for uids and flags separately
+fetch_uid_re = re.compile(rb' \(UID (\d+)[ )]')
+fetch_flags_re = re.compile(rb' FLAGS \(([^()"]*)\)')
+
+
+def fetch_value(name, kind, value):
+    """Value as string, but body sections are bytes like literals"""
+    if kind == '"' and b'\\' in value:
+        value = re.sub(rb'\\(.)', rb'\1', value)
+    if '[' not in name:
+        return value.decode()
+    elif kind == '' and value == b'NIL':
+        return b''
+    return value
+
+
+def fetch_pairs(line):
+    """Tokenize FETCH line into attrs, NIL is skipped if it's not a body"""
+    attrs = {}
+    for m in fetch_re.finditer(line):
+        name = m.group(1).decode().upper()
+        kind = fetch_kinds[m.lastindex]
+        value = m.group(m.lastindex)
+        if kind == '' and value == b'NIL' and '[' not in name:
+            continue
+        attrs[name] = fetch_value(name, kind, value)
+    return attrs
+
+
+def fetch_shape(line):
+    """Compile matcher for lines with the same items in the same order
+
+    FETCH lines of one response usually differ only in values, so
+    one anchored match is much cheaper than tokenizing every line.
+    Returns (pattern for one line, pattern for many lines, parser).
+    """
+    if re.fullmatch(fetch_flags_line, line):
+        return _fetch_flags_shape
+    items = tuple(
+        (m.group(1), fetch_kinds[m.lastindex])
+        for m in fetch_re.finditer(line)
+    )
+    return _fetch_shape(items)
+
+
+def _fetch_compile(pattern):
+    return re.compile(pattern), re.compile(rb'^%s$' % pattern, re.M)
+
+
+def _fetch_flags_attrs(row):
+    uid, flags, modseq = row
+    uid = uid.decode()
+    attrs = {'UID': uid, 'FLAGS': flags.decode()}
+    if modseq:
+        attrs['MODSEQ'] = modseq.decode()
+    return uid, attrs
+
+
+_fetch_flags_shape = (
+    _fetch_compile(fetch_flags_line) + (_fetch_flags_attrs,)
+)
+
+
+@ft.lru_cache(maxsize=64)
+def _fetch_shape(items):
+    names = tuple(name.decode().upper() for name, kind in items)
+    kinds = tuple(kind for name, kind in items)
+    # quoted values and body sections need more than decoding
+    special = [
+        i for i, name in enumerate(names) if kinds[i] == '"' or '[' in name
+    ]
+
+    def parse(row):
+        values = list(map(bytes.decode, row))
+        for i in special:
+            values[i] = fetch_value(names[i], kinds[i], row[i])
+        attrs = dict(zip(names, values))
+        return attrs.get('UID'), attrs
+
+    pattern = b' '.join(
+        re.escape(name) + b' ' + fetch_values[kind] for name, kind in items
+    )
+    return _fetch_compile(rb'\d+ \(%s ?\)' % pattern) + (parse,)
+
+
+def split_fetch(res):
+    """Group FETCH response parts by message
+
+    Literals come as tuples and the message ends with a plain line.
+    """
+    parts = []
+    for i in res:
+        if i is None:
+            continue
+        parts.append(i)
+        if not isinstance(i, tuple):
+            yield parts
+            parts = []
+    if parts:
+        yield parts
+
+
+def parse_fetch(parts):
+    """Parse FETCH response of one message into (uid, attrs)
+
+    Values are strings, body sections are bytes (empty for NIL).
+    """
+    if isinstance(parts, bytes):
+        attrs = fetch_pairs(parts)
+        return attrs.get('UID'), attrs
+
+    attrs = {}
+    line = []
+    for i in parts:
+        if isinstance(i, tuple):
+            head, literal = i
+            name = fetch_literal_re.search(head)
+            attrs[name.group(1).decode().upper()] = literal
+            line.append(head[:name.start()])
+        else:
+            line.append(i)
+    attrs.update(fetch_pairs(b''.join(line)))
+    return attrs.get('UID'), attrs
+
+
+def fetch_lines(lines, shape=None):
+    """Parse lines without literals, it returns the last shape
+
+    Many lines of the same shape are parsed with one "findall".
+    """
+    if len(lines) > 1:
+        shape = fetch_shape(lines[0])
+        rows = shape[1].findall(b'\n'.join(lines))
+        # each line is matched separately only if all lines are found
+        if len(rows) == len(lines):
+            if shape[0].groups == 1:
+                rows = zip(rows)
+            yield from map(shape[2], rows)
+            return shape
+
+    for line in lines:
+        found = shape and shape[0].fullmatch(line)
+        if not found:
+            shape = fetch_shape(line)
+            found = shape[0].fullmatch(line)
+        yield shape[2](found.groups()) if found else parse_fetch(line)
+    return shape
+
+
+def fetch_items(res):
+    """Parse FETCH response parts into (uid, attrs) items
+
+    Lines of a list are parsed together, lines of other iterables
+    (like in "iter_fetch") are parsed as soon as they are received.
+    """
+    together = isinstance(res, (list, tuple))
+    shape = None
+    lines = []
+    parts = []
+    for i in res:
+        if i is None:
+            continue
+        elif isinstance(i, tuple):
+            shape = yield from fetch_lines(lines, shape)
+            lines = []
+            parts.append(i)
+        elif parts:
+            parts.append(i)
+            yield parse_fetch(parts)
+            parts = []
+        else:
+            lines.append(i)
+            if not together:
+                shape = yield from fetch_lines(lines, shape)
+                lines = []
+    yield from fetch_lines(lines, shape)
+    if parts:
+        yield parse_fetch(parts)
+
+
+def fetch_flags(res):
+    """Parse "(UID FLAGS)" response into (uid, flags) items
+
+    It's the most common response for big mailboxes, so uids and flags
+    are found in two passes over joined lines. Lines are checked by count,
+    any other response is parsed by "fetch_items".
+    """
+    lines = [i for i in res if i is not None]
+    if all(isinstance(i, bytes) for i in lines):
+        data = b'\n'.join(lines)
+        uids = fetch_uid_re.findall(data)
+        flags = fetch_flags_re.findall(data)
+        if len(uids) == len(flags) == len(lines):
+            return zip(map(bytes.decode, uids), map(bytes.decode, flags))
+
+    return (
+        (uid, attrs['FLAGS'])
+        for uid, attrs in fetch_items(lines) if 'FLAGS' in attrs
+    )
+
+
 def pack_uids(uids):
-    uids = sorted(int(i) for i in uids)
-    result = ''
-    for i, uid in enumerate(uids):
-        if i == 0:
-            result += str(uid)
-        elif uid - uids[i-1] == 1:
-            if len(uids) == (i + 1):
-                if not result.endswith(':'):
-                    result += ':'
-                result += str(uid)
-            elif result.endswith(':'):
-                pass
-            else:
-                result += ':'
-        elif result.endswith(':'):
-            result += '%d,%d' % (uids[i-1], uid)
+    """Pack uids into compact sequence set like 1:4,7,9:10"""
+    uids = sorted(set(int(i) for i in uids))
+    return _pack_uids(uids)
+
+
+def unpack_uids(seqset):
+    """Unpack sequence set like 1:4,7 into array of uids
+
+    Order is kept as is, so "3:1" gives 3, 2, 1 like in ESORT results.
+    """
+    uids = array('I')
+    for item in seqset.split(',') if seqset else ():
+        start, _, end = item.partition(':')
+        start = int(start)
+        end = int(end) if end else start
+        step = 1 if start <= end else -1
+        uids.extend(range(start, end + step, step))
+    return uids
+
+
+def _pack_uids(uids):
+    # uids should be sorted and unique
+    ranges = []
+    start = prev = None
+    for uid in uids:
+        if prev is not None and uid == prev + 1:
+            prev = uid
+            continue
+        if start is not None:
+            ranges.append(
+                str(start) if start == prev else '%d:%d' % (start, prev)
+            )
+        start = prev = uid
+    if start is not None:
+        ranges.append(str(start) if start == prev else '%d:%d' % (start, prev))
+    return ','.join(ranges)
+
+
+class Batcher:
+    """Batch size and number of threads adapted to finished batches
+
+    Next batch is sized by average time and bytes per uid, so it takes
+    about "seconds" and reads about "size" bytes. One more thread is
+    added while throughput (uids per second) grows and one is removed
+    if it drops. If the server is throttling, both batch and threads
+    are halved.
+    """
+    retries = 5
+
+    def __init__(
+        self, batch, threads, *, limits=None, seconds=None, size=None
+    ):
+        min_batch, max_batch, max_threads = limits or (
+            conf['IMAP_BATCH_MIN'],
+            conf['IMAP_BATCH_MAX'],
+            conf['IMAP_THREADS_MAX'],
+        )
+        # initial values are given explicitly, so they extend limits
+        self.min_batch = min(min_batch, batch)
+        self.max_batch = max(max_batch, batch)
+        self.max_threads = max(max_threads, threads)
+        self.seconds = seconds or conf['IMAP_BATCH_SECONDS']
+        self.size = size or conf['IMAP_BATCH_SIZE']
+        self.batch = batch
+        self.threads = threads
+        self.uid_seconds = None
+        self.uid_size = None
+        self.throttled = 0
+        self.rate = None
+        self.reset_window()
+
+    def reset_window(self):
+        self.window = {'start': time.time(), 'batches': 0, 'uids': 0}
+
+    def done(self, count, seconds, size):
+        uid_seconds, uid_size = seconds / count, size / count
+        if self.uid_seconds is None:
+            self.uid_seconds, self.uid_size = uid_seconds, uid_size
         else:
-            result += ',%s' % uid
-    return result
+            # one slow batch shouldn't change everything
+            self.uid_seconds = (self.uid_seconds + uid_seconds) / 2
+            self.uid_size = (self.uid_size + uid_size) / 2
+
+        batch = self.seconds / max(self.uid_seconds, 1e-6)
+        if self.uid_size:
+            batch = min(batch, self.size / self.uid_size)
+        batch = min(int(batch), self.batch * 2)
+        self.batch = max(self.min_batch, min(batch, self.max_batch))
+
+        window = self.window
+        window['batches'] += 1
+        window['uids'] += count
+        if window['batches'] < self.threads * 2:
+            return
+
+        rate = window['uids'] / max(time.time() - window['start'], 1e-6)
+        if self.rate is None or rate > self.rate * 1.1:
+            self.threads = min(self.threads + 1, self.max_threads)
+        elif rate < self.rate * 0.9:
+            self.threads = max(self.threads - 1, 1)
+        self.rate = rate
+        self.reset_window()
+
+    def throttle(self):
+        """Slow down, give seconds to wait or None if it's time to give up"""
+        self.throttled += 1
+        if self.throttled > self.retries:
+            return None
+        self.batch = max(self.min_batch, self.batch // 2)
+        self.threads = max(self.threads // 2, 1)
+        self.rate = None
+        self.reset_window()
+        return min(2 ** self.throttled, 60)
+
+    def __repr__(self):
+        return str(self)
+
+    def __str__(self):
+        return '%s{batch=%s, threads=%s}' % (
+            self.__class__.__name__, self.batch, self.threads
+        )
 
 
 class Uids:
-    __slots__ = ['val', 'batches', 'threads']
+    """Sorted unique uids backed by array or sequence set as is
+
+    Iteration gives uids as strings, set operations (|, -, &) are
+    supported for non-string uids.
+    """
+    __slots__ = ['val', 'arr', 'batches', 'threads']
 
     def __init__(self, uids, *, batch=10000, threads=10):
-        if isinstance(uids, Uids):
-            uids = uids.val
         self.threads = threads
-        self.val = uids
         self.batches = None
-        if not self.is_str and len(uids) > batch:
+        if isinstance(uids, Uids):
+            self.val, self.arr = uids.val, uids.arr
+        elif isinstance(uids, (str, bytes)):
+            self.val, self.arr = uids, None
+        else:
+            if not isinstance(uids, array):
+                uids = array('I', sorted(set(int(i) for i in uids)))
+            self.val, self.arr = None, uids
+        if self.arr is not None and len(self.arr) > batch:
             self.batches = tuple(
-                Uids(uids[i:i+batch], batch=batch)
-                for i in range(0, len(uids), batch)
+                Uids(self.arr[i:i+batch], batch=batch)
+                for i in range(0, len(self.arr), batch)
             )
 
     @property
     def str(self):
         if self.is_str:
             return self.val
-        return ','.join(str(i) for i in self.val)
+        return _pack_uids(self.arr)
 
     @property
     def is_str(self):
-        return isinstance(self.val, (str, bytes))
+        return self.arr is None
+
+    def _other(self, other):
+        other = other if isinstance(other, Uids) else Uids(other)
+        if self.is_str or other.is_str:
+            raise TypeError('Set operations need uids, not sequence set')
+        return set(self.arr), set(other.arr)
+
+    def __or__(self, other):
+        a, b = self._other(other)
+        return Uids(a | b)
+
+    def __sub__(self, other):
+        a, b = self._other(other)
+        return Uids(a - b)
+
+    def __and__(self, other):
+        a, b = self._other(other)
+        return Uids(a & b)
+
+    def __iter__(self):
+        if self.is_str:
+            raise TypeError('Sequence set %r is not iterable' % self.val)
+        return (str(i) for i in self.arr)
+
+    def __len__(self):
+        if self.is_str:
+            raise TypeError('Sequence set %r has no length' % self.val)
+        return len(self.arr)
+
+    def __bool__(self):
+        return bool(self.val) if self.is_str else len(self.arr) > 0
 
     def _call(self, fn, *args):
-        num, uids = [i for i in enumerate(args) if self == i[1]][0]
+        num = [i for i, arg in enumerate(args) if arg is self][0]
         args = list(args)
-        for i, few in enumerate(uids.batches or ([self] if self.val else [])):
+        for i, few in enumerate(self.batches or ([self] if self else [])):
             args[num] = few
             f = ft.partial(fn, *args)
             desc = fn_desc(fn, *args)
@@ -616,25 +1910,118 @@ class Uids:
 
     @fn_time
     def call_async(self, fn, *args):
+        """Call "fn" for batches of uids in parallel
+
+        Batch size and number of threads are adapted by "Batcher" while
+        batches are finished; throttled batches are retried.
+        """
         if not self.batches:
             return self.call(fn, *args)
 
-        def get_exceptions():
-            return [j.exception for j in jobs if j.exception]
-
-        jobs = []
-        pool = Pool(self.threads)
-        for f in self._call(fn, *args):
-            if pool.wait_available():
-                if get_exceptions():
-                    break
-                jobs.append(pool.spawn(f))
-        pool.join()
+        num = [i for i, arg in enumerate(args) if arg is self][0]
+        batcher = Batcher(len(self.batches[0]), self.threads)
+
+        def run(few, label):
+            args_ = list(args)
+            args_[num] = few
+            f = ft.partial(fn, *args_)
+            f = fn_time(f, '#%s %s' % (label, fn_desc(fn, *args_)))
+            current = getcurrent()
+            received[current] = 0
+            start = time.time()
+            try:
+                return f(), time.time() - start, received[current]
+            finally:
+                received.pop(current)
+
+        # uids are split lazily, so next batch has size known by now
+        todo = deque([(0, self.arr)])
+        labels = count()
+        jobs = {}
+        results = {}
+        exceptions = []
+        while todo or jobs:
+            while todo and not exceptions and len(jobs) < batcher.threads:
+                offset, arr = todo.popleft()
+                size = batcher.batch
+                if len(arr) > size:
+                    todo.appendleft((offset + size, arr[size:]))
+                    arr = arr[:size]
+                few = Uids(arr, batch=len(arr))
+                jobs[spawn(run, few, next(labels))] = offset, arr
+            if not jobs:
+                break
+
+            for job in wait(list(jobs), count=1):
+                offset, arr = jobs.pop(job)
+                if job.successful():
+                    results[offset], seconds, size = job.value
+                    batcher.done(len(arr), seconds, size)
+                    continue
+
+                delay = None
+                if throttled_re.search(str(job.exception)):
+                    delay = batcher.throttle()
+                if delay is None:
+                    exceptions.append(job.exception)
+                    continue
+                log.warning(
+                    'throttled, retry in %ss: %r', delay, job.exception
+                )
+                todo.appendleft((offset, arr))
+                sleep(delay)
 
-        exceptions = get_exceptions()
         if exceptions:
             raise ValueError('Exception in the pool: %s' % exceptions)
-        return (f.value for f in jobs)
+        return (results[i] for i in sorted(results))
+
+    @fn_time
+    def pipeline(self, con, name, *args):
+        """Send UID command for all batches back to back
+
+        Batches on the same connection are not waiting for each other,
+        only UID commands can be pipelined (RFC 3501, section 5.5).
+        """
+        name = 'UID %s' % name
+        args = ' '.join(args)
+        with con.lock:
+            tags = [con._new_tag() for few in self.batches]
+
+            def send():
+                for tag, few in zip(tags, self.batches):
+                    line = '%s %s %s' % (name, few.str, args)
+                    con.send(tag + b' ' + line.encode() + CRLF)
+
+            def failed(sender):
+                # responses for commands which weren't sent never come
+                reader.throw(sender.exception)
+
+            # responses are read at the same time, so the server
+            # is never blocked by full socket buffers
+            reader = getcurrent()
+            sender = spawn(send)
+            sender.link_exception(failed)
+            results = []
+            try:
+                for tag in tags:
+                    try:
+                        results.append(con._command_complete(name, tag))
+                    except con.abort:
+                        raise
+                    except con.error as e:
+                        results.append(('BAD', [str(e)]))
+                sender.join()
+            except BaseException:
+                # a command can be sent or read partially, so
+                # the connection isn't usable anymore
+                sender.unlink(failed)
+                sender.kill()
+                shutdown(con)
+                raise
+            res = con.untagged_responses.pop('FETCH', [])
+        for i in results:
+            check(i)
+        return [i for i in res if i is not None]
 
     def __repr__(self):
         return str(self)
@@ -645,7 +2032,7 @@ class Uids:
             uids = self.val
             uids = uids if isinstance(uids, str) else uids.decode()
             return uids if ':' in uids else fmt % (uids.count(',') + 1)
-        if len(self.val) < 5:
+        if len(self.arr) < 5:
             # show few uids as is
-            return str(self.val)
-        return fmt % len(self.val)
+            return str(list(self))
+        return fmt % len(self.arr)
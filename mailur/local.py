@@ -3,11 +3,14 @@ import functools as ft
 import hashlib
 import imaplib
 import re
+import sys
 import textwrap
+import zlib
+from collections import Counter
 
 from gevent import joinall, socket, spawn
 
-from . import cache, conf, fn_time, html, imap, json, lock, log, message
+from . import cache, conf, fn_time, html, imap, json, lock, log, message, pack
 
 SRC = 'mlr'
 ALL = 'mlr/All'
@@ -28,7 +31,11 @@ class Local(imaplib.IMAP4, imap.Conn):
 def connect(username, password):
     con = Local(username)
     imap.login(con, username, password)
-    imap.enable(con, 'CONDSTORE')
+    # QRESYNC implies CONDSTORE and gives VANISHED for expunged uids
+    if 'QRESYNC' in con.capabilities:
+        imap.enable(con, 'QRESYNC')
+    else:
+        imap.enable(con, 'CONDSTORE')
 
     # For searching with non ascii symbols (Dovecot understands this)
     con._encoding = 'utf-8'
@@ -55,70 +62,329 @@ def using(box=ALL, **kw):
 
 @using(SYS)
 def metadata_uids(con=None):
+    """Latest uid of each metadata value from its Subject
+
+    Patches of a value are listed under "<name>.log", only the ones
+    appended after the latest snapshot of the value are kept there.
+    """
     def get_map():
         uids = {}
+        logs = {}
         all_uids = set()
-        res = con.fetch('1:*', '(UID BODY[HEADER.FIELDS (Subject)])')
-        for i in range(0, len(res), 2):
-            uid = res[i][0].decode().split()[2]
-            name = re.sub(r'^Subject: ?', '', res[i][1].decode()).strip()
-            if name not in uids or int(uids[name]) < int(uid):
-                uids[name] = uid
+        res = con.iter_fetch('1:*', '(UID BODY[HEADER.FIELDS (Subject)])')
+        for uid, attrs in res:
+            name = attrs['BODY[HEADER.FIELDS (SUBJECT)]'].decode()
+            name = re.sub(r'^Subject: ?', '', name).strip()
             all_uids.add(uid)
-        clean = all_uids.difference(uids.values())
+            if name.endswith('.log'):
+                logs.setdefault(name, []).append(uid)
+            elif name not in uids or int(uids[name]) < int(uid):
+                uids[name] = uid
+        live = set(uids.values())
+        for name, found in logs.items():
+            snapshot = int(uids.get(name[:-len('.log')], 0))
+            found = sorted((i for i in found if int(i) > snapshot), key=int)
+            if found:
+                uids[name] = found
+                live.update(found)
+        cache.disk_clean(con.uidvalidity, live)
+        clean = all_uids.difference(live)
         if clean and len(clean) > 100:
             with client(SYS, readonly=False) as c:
                 c.store(clean, '+FLAGS.SILENT', '\\Deleted')
-                c.expunge()
+                c.expunge(clean)
         return uids
 
     get_map = fn_time(get_map, 'metadata_uids.get_map')
 
     cache_key = 'metadata'
     value = cache.get(cache_key)
-    if not value or con.uidnext != value['uidnext']:
-        data = {'uidnext': con.uidnext, 'map': get_map()}
+    if not value or int(con.uidnext) != value['uidnext']:
+        data = {'uidnext': int(con.uidnext), 'map': get_map()}
         cache.set(cache_key, data)
     return cache.get(cache_key)['map']
 
 
-def metadata(name, default):
+def metadata_append(con, name, data, checksum=None, disk=False):
+    if isinstance(data, str):
+        data = data.encode()
+    if pack.is_packed(data):
+        msg = message.new()
+        msg.set_content(data, 'application', 'octet-stream')
+    else:
+        msg = message.binary(data.decode())
+    msg.add_header('Subject', name)
+    if checksum is not None:
+        # checksum of JSON, so a packed value isn't encoded for comparing
+        msg.add_header('X-Checksum', str(checksum))
+    uid = con.append(SYS, name, None, msg.as_bytes())
+    if disk:
+        cache.disk_set(con.uidvalidity, {uid: (data, checksum)})
+
+    # the map is still valid if nothing else was appended since then
+    found = cache.get('metadata')
+    if found and found['uidnext'] == int(uid):
+        found['uidnext'] = int(uid) + 1
+        if name.endswith('.log'):
+            found['map'].setdefault(name, []).append(uid)
+        else:
+            found['map'][name] = uid
+            found['map'].pop('%s.log' % name, None)
+    return uid
+
+
+def metadata_fetch(con, uids, disk=False):
+    """Bodies of Sys messages as {uid: (data, checksum)}
+
+    With "disk", the disk cache is used first, so a fresh process doesn't
+    download values fetched by other processes before.
+    """
+    found = cache.disk_get(con.uidvalidity, uids) if disk else {}
+    missing = [i for i in uids if i not in found]
+    if not missing:
+        return found
+
+    fetched = {}
+    fields = 'BODY.PEEK[HEADER.FIELDS (X-Checksum)] BINARY.PEEK[1]'
+    for uid, attrs in con.iter_fetch(missing, '(UID %s)' % fields):
+        checksum = attrs['BODY[HEADER.FIELDS (X-CHECKSUM)]'].decode()
+        checksum = re.sub(r'^X-Checksum: ?', '', checksum).strip()
+        checksum = int(checksum) if checksum else None
+        fetched[uid] = (attrs['BINARY[1]'], checksum)
+    if disk:
+        cache.disk_set(con.uidvalidity, fetched)
+    found.update(fetched)
+    return found
+
+
+def metadata_parts(value):
+    # a value is a dict or a list of dicts like [thrids, thrs]
+    return value if isinstance(value, (list, tuple)) else [value]
+
+
+def metadata_prints(value):
+    return [
+        {k: hash(json.dumps(v, sort_keys=True)) for k, v in part.items()}
+        for part in metadata_parts(value)
+    ]
+
+
+def metadata_diff(prints, value):
+    """Patch like [[{changed key: value}, [removed key]], ...]"""
+    patch = []
+    new_prints = metadata_prints(value)
+    for old, new, part in zip(prints, new_prints, metadata_parts(value)):
+        changed = {k: part[k] for k, v in new.items() if old.get(k) != v}
+        removed = [k for k in old if k not in new]
+        patch.append([changed, removed])
+    return patch, new_prints
+
+
+def metadata_fold(value, prints, patch):
+    parts = zip(metadata_parts(value), prints, patch)
+    for part, part_prints, (changed, removed) in parts:
+        part.update(changed)
+        part_prints.update(metadata_prints(changed)[0])
+        for key in removed:
+            part.pop(key, None)
+            part_prints.pop(key, None)
+
+
+def metadata_split(name, value, size):
+    """Split value keyed by uid into {"<name>/<number>": part}"""
+    parts = metadata_parts(value)
+    shards = {}
+    for i, part in enumerate(parts):
+        for key, val in part.items():
+            subject = '%s/%04d' % (name, int(key) // size)
+            shard = shards.setdefault(subject, [{} for _ in parts])
+            shard[i][key] = val
+    if not isinstance(value, (list, tuple)):
+        shards = {k: v[0] for k, v in shards.items()}
+    return shards
+
+
+def metadata(
+    name, default, log=False, shard=None, binary=False, disk=False
+):
+    """Value saved as a message with Subject "name" in "mlr/Sys"
+
+    With "log", only patches are appended under "<name>.log" and a full
+    snapshot is saved again after "METADATA_LOG" patches.
+
+    With "shard", a value keyed by uid is split by ranges of "shard" uids
+    into messages like "msgs/0001", only changed ones are saved again
+    and "get(uids)" fetches only ones needed for these uids. A value saved
+    as one message before is expunged by the first sharded save.
+
+    With "binary", a value is saved in "pack" format, JSON is read too.
+
+    With "disk", fetched messages are kept in the disk cache, so it's
+    only for values without secrets (not for "settings").
+    """
     cache_key = 'metadata:%s' % name
+    shards_key = 'metadata:%s/' % name
+    log_name = '%s.log' % name
+
+    def latest(uids):
+        uidlatest = uids.get(name)
+        logs = uids.get(log_name, []) if log or shard else []
+        return uidlatest, logs[-1] if logs else uidlatest
+
+    def shard_uids(uids):
+        prefix = '%s/' % name
+        return {k: v for k, v in uids.items() if k.startswith(prefix)}
+
+    def save_shards(con, val):
+        con.select(SYS)
+        uids = metadata_uids(con=con)
+        shards = cache.get(shards_key) or {}
+        found = metadata_split(name, val, shard)
+        # emptied shards are saved too, the first one marks the format
+        for subject in shard_uids(uids):
+            found.setdefault(subject, default())
+        found.setdefault('%s/%04d' % (name, 0), default())
+        for subject, part in sorted(found.items()):
+            data = json.dumps(part, sort_keys=True).encode()
+            checksum = zlib.crc32(data)
+            saved = shards.get(subject)
+            if saved and saved[:2] == (uids.get(subject), checksum):
+                continue
+            if binary:
+                data = pack.dumps(part)
+            uid = metadata_append(con, subject, data, checksum, disk)
+            shards[subject] = (uid, checksum, part)
+        cache.set(shards_key, shards)
+        clean_legacy(uids)
+        saved = {k: shards[k][0] for k in found}
+        # items are shared with shards, so only the dicts are counted
+        size = sum(map(sys.getsizeof, metadata_parts(val)))
+        cache.set(cache_key, (saved, val), size=size)
+
+    def clean_legacy(uids):
+        # the value saved as one message before sharding
+        # with its patches, it's read until the first sharded save
+        legacy = [uids[name]] if name in uids else []
+        legacy += uids.get(log_name, [])
+        if not legacy:
+            return
+
+        with client(SYS, readonly=False) as c:
+            c.store(legacy, '+FLAGS.SILENT', '\\Deleted')
+            c.expunge(legacy)
+        found = cache.get('metadata')
+        if found:
+            found['map'].pop(name, None)
+            found['map'].pop(log_name, None)
+
+    def get_shards(con, saved, uids=None):
+        cached = cache.get(cache_key)
+        if cached and cached[0] == saved:
+            return cached[1]
+        elif uids is not None:
+            needed = {'%s/%04d' % (name, int(i) // shard) for i in uids}
+            saved = {k: v for k, v in saved.items() if k in needed}
+
+        shards = cache.get(shards_key) or {}
+        missing = {
+            uid: subject for subject, uid in saved.items()
+            if shards.get(subject, [None])[0] != uid
+        }
+        if missing:
+            res = metadata_fetch(con, list(missing), disk)
+            for uid, (data, checksum) in res.items():
+                if checksum is None:
+                    checksum = zlib.crc32(data)
+                shards[missing[uid]] = (uid, checksum, pack.loads(data))
+            cache.set(shards_key, shards)
+
+        value = default()
+        for subject in sorted(saved):
+            if subject not in shards:
+                continue
+            found = metadata_parts(shards[subject][2])
+            for part, shard_part in zip(metadata_parts(value), found):
+                part.update(shard_part)
+        if uids is None:
+            size = sum(map(sys.getsizeof, metadata_parts(value)))
+            cache.set(cache_key, (saved, value), size=size)
+        return value
 
     @using(SYS, name='_con')
     @lock.user_scope(name)
     def inner(*a, **kw):
         con = kw.pop('_con')
         val = inner.fn(*a, **kw)
-        data = json.dumps(val, sort_keys=True)
-        msg = message.binary(data)
-        msg.add_header('Subject', name)
-        uidlatest = con.append(SYS, name, None, msg.as_bytes())
-        cache.set(cache_key, (uidlatest, val))
+        if shard:
+            save_shards(con, val)
+            return val
+
+        cached = cache.get(cache_key) if log else None
+        if cached:
+            # a patch is valid only for the latest saved value
+            con.select(SYS)
+            uids = metadata_uids(con=con)
+            saved = latest(uids)
+            logs = uids.get(log_name, [])
+            if cached[0] == saved and len(logs) < conf['METADATA_LOG']:
+                patch, prints = metadata_diff(cached[2], val)
+                if any(changed or removed for changed, removed in patch):
+                    data = json.dumps(patch, sort_keys=True)
+                    uid = metadata_append(con, log_name, data, disk=disk)
+                    saved = saved[0], uid
+                cache.set(cache_key, (saved, val, prints))
+                return val
+
+        data = pack.dumps(val) if binary else json.dumps(val, sort_keys=True)
+        uid = metadata_append(con, name, data, disk=disk)
+        prints = metadata_prints(val) if log else None
+        cache.set(cache_key, ((uid, uid), val, prints))
         return val
 
     @using(SYS)
-    def get(con=None):
-        uidlatest = metadata_uids(con=con).get(name)
+    def get(uids=None, con=None):
+        """Full value or only shards with given uids if it's sharded"""
+        wanted, uids = uids, metadata_uids(con=con)
+        if shard and shard_uids(uids):
+            return get_shards(con, shard_uids(uids), wanted)
+
+        saved = latest(uids)
+        uidlatest = saved[0]
         if not uidlatest:
             if isinstance(default, Exception):
                 raise default
             return default()
 
-        if cache.exists(cache_key):
-            uid, value = cache.get(cache_key)
-            if uid == uidlatest:
-                return value
+        cached = cache.get(cache_key)
+        if cached and cached[0] == saved:
+            return cached[1]
 
         def fetch():
-            res = con.fetch(uidlatest, 'BODY.PEEK[1]')
-            if res and res[0]:
-                data = json.loads(res[0][1].decode())
-                return data
+            res = metadata_fetch(con, [uidlatest], disk)
+            if uidlatest in res:
+                return pack.loads(res[uidlatest][0])
             return default()
 
-        value = fn_time(fetch, '%s.fetch' % inner.__name__)()
-        cache.set(cache_key, (uidlatest, value))
+        def fetch_logs(uids):
+            res = metadata_fetch(con, uids, disk)
+            res = sorted(res.items(), key=lambda i: int(i[0]))
+            return [pack.loads(data) for _, (data, _) in res]
+
+        applied = uidlatest
+        if cached and cached[0][0] == uidlatest:
+            # only new patches are needed for the same snapshot
+            value, prints = cached[1], cached[2]
+            applied = cached[0][1]
+        else:
+            value = fn_time(fetch, '%s.fetch' % inner.__name__)()
+            prints = metadata_prints(value) if log or shard else None
+
+        logs = [i for i in uids.get(log_name, []) if int(i) > int(applied)]
+        if logs:
+            fetch_logs = fn_time(fetch_logs, '%s.fetch_logs' % name)
+            for patch in fetch_logs(logs):
+                metadata_fold(value, prints, patch)
+        cache.set(cache_key, (saved, value, prints))
         return value
 
     def key(name, default=None):
@@ -188,6 +454,11 @@ def data_modseq(value):
     return value
 
 
+@setting('qresync')
+def data_qresync(value):
+    return value
+
+
 @setting('links', lambda: [])
 def data_links(links):
     return links
@@ -272,34 +543,36 @@ def tags_info(con=None):
         return 'keyword %s' % tag
 
     thrids, thrs = data_threads.get()
-    unread_uids = set(con.search('(UNSEEN UNKEYWORD #trash UNKEYWORD #spam)'))
+    # only sequence sets are transferred, not full lists of uids
+    unread = con.esearch(
+        '(UNSEEN UNKEYWORD #trash UNKEYWORD #spam)', ret=['COUNT', 'ALL']
+    )
+    unread_thrs = Counter(
+        thrids.get(str(uid)) for uid in imap.unpack_uids(unread['all'])
+    )
+    unread_thrs.pop(None, None)
     special = {
         '\\Seen', '\\Deleted', '\\Answered', '\\Flagged', '\\Draft',
         '#trash', '#spam', '#sent', '#err'
     }
     tags = {
-        '#unread': {'unread': len(unread_uids)},
+        '#unread': {'unread': unread['count']},
         '#inbox': {'pinned': 1, 'unread': 0}
     }
     tags_info = data_tags.get()
     for tag in con.flags:
         if tag in special:
             continue
-        uids = con.search(query(tag))
+        uids = con.esearch(query(tag), ret=['ALL'])['all']
         if not uids:
             continue
         tags.setdefault(tag, {'unread': 0})
         name = tags_info.get(tag, {}).get('name', tag)
         if not re.search('^[#.-]', name):
             continue
-        unread = set()
-        for uid in uids:
-            thrid = thrids.get(uid)
-            if not thrid:
-                continue
-            thr = thrs[thrid]
-            unread.update(unread_uids.intersection(thr))
-        tags[tag].update(unread=len(unread), pinned=1)
+        tag_thrs = {thrids.get(str(uid)) for uid in imap.unpack_uids(uids)}
+        count = sum(unread_thrs[i] for i in tag_thrs if i)
+        tags[tag].update(unread=count, pinned=1)
     tags = {t: dict(get_tag(t, tags=tags_info), **v) for t, v in tags.items()}
     tags.update({
         t: dict(get_tag(t, tags=tags_info), **tags.get(t, {'unread': 0}))
@@ -353,22 +626,22 @@ def sieve_scripts(name=None):
     return data[name] if name else data
 
 
-@metadata('uidpairs', lambda: {})
+@metadata('uidpairs', lambda: {}, log=True, disk=True)
 def data_uidpairs(pairs):
     return pairs
 
 
-@metadata('addresses', lambda: ({}, {}))
+@metadata('addresses', lambda: ({}, {}), log=True, disk=True)
 def data_addresses(addrs_from, addrs_to):
     return [addrs_from, addrs_to]
 
 
-@metadata('msgs', lambda: {})
+@metadata('msgs', lambda: {}, shard=10000, binary=True, disk=True)
 def data_msgs(msgs):
     return msgs
 
 
-@metadata('msgids', lambda: {})
+@metadata('msgids', lambda: {}, log=True, disk=True)
 def data_msgids(mids):
     return mids
 
@@ -539,11 +812,10 @@ def update_metadata(uids=None, clean=False, con=None):
             elif store[a]['time'] < meta['date']:
                 store[a]['time'] = meta['date']
 
-    res = con.fetch(imap.Uids(uids), '(FLAGS BINARY.PEEK[1])')
-    for i in range(0, len(res), 2):
-        pattern = r'UID (\d+) FLAGS \(([^)]*)\)'
-        uid, flags = re.search(pattern, res[i][0].decode()).groups()
-        info = json.loads(res[i][1])
+    res = con.iter_fetch(imap.Uids(uids), '(FLAGS BINARY.PEEK[1])')
+    for uid, attrs in res:
+        flags = attrs['FLAGS']
+        info = json.loads(attrs['BINARY[1]'])
         keys = ('arrived', 'draft_id', 'msgid', 'origin_uid', 'from', 'parent')
         small_info = {k: v for k, v in info.items() if k in keys}
         msgs[uid] = small_info
@@ -609,21 +881,21 @@ def unlink_threads(uids):
 
 
 @using(SRC, reuse=False)
-def parse_msgs(uids, con=None):
-    res = con.fetch(uids.str, '(UID INTERNALDATE FLAGS BODY.PEEK[])')
-
+@using(None, name='con_all', reuse=False)
+def parse_msgs(uids, con=None, con_all=None):
     def msgs():
-        for i in range(0, len(res), 2):
-            line, body = res[i]
-            pattern = r'UID (\d+) INTERNALDATE ("[^"]+") FLAGS \(([^)]*)\)'
-            uid, time, flags = re.search(pattern, line.decode()).groups()
-            flags = flags.split()
+        fields = '(UID INTERNALDATE FLAGS BODY.PEEK[])'
+        for uid, attrs in con.iter_fetch(uids, fields):
+            time = '"%s"' % attrs['INTERNALDATE']
+            flags = attrs['FLAGS'].split()
+            body = attrs['BODY[]']
             msg_obj, marks = message.parsed(body, uid, time, flags)
             flags += marks
             msg = msg_obj.as_bytes()
             yield time, ' '.join(flags), msg
 
-    return con.multiappend(ALL, list(msgs()))
+    # messages are streamed from one connection to another
+    return con_all.multiappend(ALL, msgs())
 
 
 @fn_time
@@ -632,8 +904,8 @@ def clean_parsed_msgs(uids, con=None):
     uids = imap.Uids(uids)
     log.info('## deleting %s from %r', uids, ALL)
     con.store(uids, '+FLAGS.SILENT', '\\Deleted')
-    con.expunge()
-    update_metadata(uids.val, clean=True)
+    con.expunge(uids)
+    update_metadata(list(uids), clean=True)
 
 
 @fn_time
@@ -686,7 +958,7 @@ def parse(criteria=None, con=None, **opts):
     sieve_run('UID %s' % uids.str, sieve_scripts('auto'))
 
 
-@metadata('threads', lambda: [{}, {}])
+@metadata('threads', lambda: [{}, {}], shard=10000, disk=True)
 def data_threads(thrids, thrs):
     return [thrids, thrs]
 
@@ -758,7 +1030,7 @@ def msgs_flag(uids, old, new, con_src=None, con_all=None):
         if add:
             con.store(uids, '+FLAGS.SILENT', ' '.join(add))
         if '\\Deleted' in add:
-            con.expunge()
+            con.expunge(uids)
 
     jobs = [
         spawn(store, con_all, uids),
@@ -767,12 +1039,18 @@ def msgs_flag(uids, old, new, con_src=None, con_all=None):
     joinall(jobs, raise_error=True)
 
 
-@using(SRC)
-def msgs_expunge(tag, con=None):
-    uids = con.search('KEYWORD %s' % tag)
-    con.copy(uids, DEL)
+@fn_time
+@using(SRC, name='con_src', readonly=False)
+@using(ALL, name='con_all', readonly=False)
+def msgs_expunge(tag, con_src=None, con_all=None):
+    uids = con_src.search('KEYWORD %s' % tag)
+    if not uids:
+        return
+
     parsed_uids = pair_origin_uids(uids)
-    msgs_flag(parsed_uids, [], ['\\Deleted'])
+    con_src.move(uids, DEL)
+    con_all.store(parsed_uids, '+FLAGS.SILENT', '\\Deleted')
+    con_all.expunge(parsed_uids)
     update_metadata(parsed_uids, clean=True)
 
 
@@ -795,8 +1073,8 @@ def sync_flags_to_all(con_src=None, con_all=None):
             continue
         q = flag[1:] if flag.startswith('\\') else 'keyword %s' % flag
         oids = con_src.search(q)
-        pairs = set(pair_origin_uids(oids))
-        pids = set(con_all.search(q))
+        pairs = imap.Uids(pair_origin_uids(oids))
+        pids = imap.Uids(con_all.search(q))
         con_all.store(pairs - pids, '+FLAGS.SILENT', flag)
         con_all.store(pids - pairs, '-FLAGS.SILENT', flag)
     rm_flags = set(con_all.flags) - set(con_src.flags) - skip_flags
@@ -813,8 +1091,8 @@ def sync_flags_to_src(con_src=None, con_all=None):
             continue
         q = flag[1:] if flag.startswith('\\') else 'keyword %s' % flag
         pids = con_all.search(q)
-        pairs = set(pair_parsed_uids(pids))
-        oids = set(con_src.search(q))
+        pairs = imap.Uids(pair_parsed_uids(pids))
+        oids = imap.Uids(con_src.search(q))
         con_src.store(pairs - oids, '+FLAGS.SILENT', flag)
         con_src.store(oids - pairs, '-FLAGS.SILENT', flag)
     rm_flags = set(con_src.flags) - set(con_all.flags)
@@ -822,6 +1100,29 @@ def sync_flags_to_src(con_src=None, con_all=None):
         con_src.store('1:*', '-FLAGS.SILENT', ' '.join(rm_flags))
 
 
+@fn_time
+@using(None, reuse=False)
+def sync_vanished(con=None):
+    """Clean metadata of messages expunged from ALL since the last run
+
+    Saved UIDVALIDITY and HIGHESTMODSEQ are sent with QRESYNC, so only
+    expunged uids are received, there is no full mailbox scan.
+    """
+    saved = data_qresync.get()
+    con.select(ALL, qresync=saved)
+    if not saved:
+        log.info('## vanished: nothing saved yet')
+    elif saved[0] != con.uidvalidity:
+        log.warning(
+            '## vanished: UIDVALIDITY is changed %s -> %s',
+            saved[0], con.uidvalidity
+        )
+    elif con.vanished:
+        log.info('## vanished: %s', imap.Uids(con.vanished))
+        update_metadata(con.vanished, clean=True)
+    data_qresync([con.uidvalidity, con.highestmodseq])
+
+
 @fn_time
 @using(SRC, reuse=False)
 def sync_flags(con=None, post_handler=None, timeout=None):
@@ -829,23 +1130,17 @@ def sync_flags(con=None, post_handler=None, timeout=None):
     @using(ALL, name='con_all', readonly=False, reuse=False)
     def handler(res, con_src=None, con_all=None):
         cur_modseq = con.highestmodseq
-        new_modseq = re.search(r'MODSEQ \((\d+)\)', res[0].decode()).group(1)
-        new_modseq = int(new_modseq)
+        new_modseq = int(imap.parse_fetch(res[0])[1]['MODSEQ'])
         if new_modseq < cur_modseq:
             return
         fields = '(UID FLAGS) (CHANGEDSINCE %s)' % cur_modseq
         res = con_src.fetch('1:*', fields)
         cur_modseq = new_modseq
         src_flags = {}
-        for line in res:
-            val = re.search(
-                r'UID (\d+) FLAGS \(([^)]*)\) MODSEQ \(\d+\)',
-                line.decode()
-            )
-            if not val:
+        for uid, attrs in imap.fetch_items(res):
+            if 'FLAGS' not in attrs or 'MODSEQ' not in attrs:
                 continue
-            uid, flags = val.groups()
-            src_flags[uid] = flags
+            src_flags[uid] = attrs['FLAGS']
 
         if not src_flags:
             return
@@ -854,9 +1149,7 @@ def sync_flags(con=None, post_handler=None, timeout=None):
         parsed = data_msgs.get()
         pids = pair_origin_uids(src_flags)
         res = con_all.fetch(pids, '(UID FLAGS)')
-        for line in res:
-            pattern = r'UID (\d+) FLAGS \(([^)]*)\)'
-            uid, flags = re.search(pattern, line.decode()).groups()
+        for uid, flags in imap.fetch_flags(res):
             flags = set(flags.split())
             orig_flags = set(src_flags[parsed[uid]['origin_uid']].split())
             val = sorted(orig_flags - flags)
@@ -879,8 +1172,13 @@ def sync_flags(con=None, post_handler=None, timeout=None):
         '%s UIDVALIDITY=%s HIGHESTMODSEQ=%s',
         con, con.uidvalidity, con.highestmodseq
     )
-    con.select(SRC)
-    con.idle({'FETCH': handler}, timeout=timeout)
+    # expunged messages are reported by VANISHED with QRESYNC
+    # or by STATUS with NOTIFY (see "imap.watch")
+    handlers = {
+        SRC: {'FETCH': handler},
+        ALL: {'VANISHED': lambda res: sync_vanished()},
+    }
+    con.watch(handlers, timeout=timeout)
 
 
 @fn_time
@@ -914,16 +1212,22 @@ def fetch_msg(uid, draft=False, con=None):
         % ('2' if draft else '1')
     )
     res = con.fetch(uid, fields)
-    flags = re.search(r'FLAGS \(([^)]*)\)', res[0][0].decode()).group(1)
-    head = email.message_from_string(res[0][1].decode())
-    meta = json.loads(res[1][1].decode())
-    txt = res[2][1].decode()
+    _, attrs = next(imap.fetch_items(res))
+    flags = attrs['FLAGS']
+    head = email.message_from_string(attrs['BINARY[HEADER]'].decode())
+    meta = json.loads(attrs['BINARY[1]'].decode())
+    txt = attrs['BINARY[2.%s]' % ('2' if draft else '1')].decode()
     return flags, head, meta, txt
 
 
 @fn_time
 @using()
-def search_msgs(query, sort='(REVERSE ARRIVAL)', con=None):
+def search_msgs(query, sort='(REVERSE ARRIVAL)', partial=None, con=None):
+    if partial:
+        uids, count = con.sort(sort, query, partial=partial)
+        log.debug('query: %r; messages: %s of %s', query, len(uids), count)
+        return uids, count
+
     uids = con.sort(sort, query)
     log.debug('query: %r; messages: %s', query, len(uids))
     return uids
@@ -933,11 +1237,8 @@ def search_msgs(query, sort='(REVERSE ARRIVAL)', con=None):
 @using()
 def msgs_info(uids, con=None):
     res = con.fetch(uids, '(UID FLAGS BINARY.PEEK[1])')
-    for i in range(0, len(res), 2):
-        pattern = r'UID (\d+) FLAGS \(([^)]*)\)'
-        uid, flags = re.search(pattern, res[i][0].decode()).groups()
-        flags = flags.split()
-        yield uid, res[i][1], flags, None
+    for uid, attrs in imap.fetch_items(res):
+        yield uid, attrs['BINARY[1]'], attrs['FLAGS'].split(), None
 
 
 @fn_time
@@ -946,8 +1247,7 @@ def msgs_body(uids, fix_privacy=False, con=None):
     msgs = data_msgs.get()
     drafts = data_drafts.get()
     res = con.fetch(uids, '(UID BINARY.PEEK[2.1])')
-    for i in range(0, len(res), 2):
-        uid = res[i][0].decode().split()[2]
+    for uid, attrs in imap.fetch_items(res):
         if uid not in msgs:
             continue
         draft_id = msgs[uid].get('draft_id')
@@ -958,7 +1258,7 @@ def msgs_body(uids, fix_privacy=False, con=None):
                 if p
             )
         else:
-            body = res[i][1].decode()
+            body = attrs['BINARY[2.1]'].decode()
         body = html.fix_privacy(body, only_proxy=not fix_privacy)
         yield uid, body
 
@@ -997,20 +1297,20 @@ def thrs_info(uids, tags=None, con=None):
     elif '#spam' in tags:
         special_tag = '#spam'
 
-    msgs = data_msgs.get()
-    thrids, all_thrs = data_threads.get()
+    # only shards with needed uids are loaded
+    thrids = data_threads.get(uids)[0]
     uids = [thrids[uid] for uid in uids if uid in thrids]
     if not uids:
         return
 
+    all_thrs = data_threads.get(uids)[1]
     all_uids = sum((all_thrs[uid] for uid in uids), [])
+    msgs = data_msgs.get(all_uids)
     all_uids = imap.Uids(all_uids)
 
     all_flags = {}
     res = con.fetch(all_uids, '(UID FLAGS)')
-    for line in res:
-        pattern = r'UID (\d+) FLAGS \(([^)]*)\)'
-        uid, flags = re.search(pattern, line.decode()).groups()
+    for uid, flags in imap.fetch_flags(res):
         all_flags[uid] = flags.split()
 
     thrs = {}
@@ -1054,9 +1354,8 @@ def thrs_info(uids, tags=None, con=None):
         return
 
     res = con.fetch(imap.Uids(thrs.keys()), 'BINARY.PEEK[1]')
-    for i in range(0, len(res), 2):
-        uid = res[i][0].decode().split()[2]
-        info = json.loads(res[i][1])
+    for uid, attrs in imap.fetch_items(res):
+        info = json.loads(attrs['BINARY[1]'])
         thr = thrs[uid]
         info['uids'] = thr['uids']
         if thr['draft_id']:
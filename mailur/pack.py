@@ -0,0 +1,193 @@
+"""Compact binary format for metadata like {uid: {key: value}}
+
+Layout (little-endian):
+    MAGIC with VERSION,
+    lengths of "head", "table", "uids" and "numbers" as uint32,
+    head: JSON {"shapes": [[key, ...], ...], "counts": [records, ...]},
+    table: JSON list of interned values (addresses, message-ids, etc.),
+    uids: uint32 for each record, grouped by shape (set of keys),
+    numbers: uint32 for each interned string like "123" (origin uids),
+    refs: uint32 for each value, an index in "table" + "numbers",
+          a column per key of each shape.
+"""
+import gc
+import struct
+import sys
+from array import array
+from itertools import islice, repeat
+
+from . import json
+
+MAGIC = b'MLR'
+VERSION = 1
+header = struct.Struct('<IIII')
+
+
+class Error(Exception):
+    pass
+
+
+def _uint(txt):
+    # only strings which are restored as they are, so no leading zeros
+    if txt.isdigit() and txt.isascii() and (txt[0] != '0' or txt == '0'):
+        num = int(txt)
+        if num < 2 ** 32:
+            return num
+
+
+def _array(items):
+    items = array('I', items)
+    if sys.byteorder == 'big':
+        items.byteswap()
+    return items
+
+
+def _unarray(data):
+    items = array('I')
+    items.frombytes(data)
+    if sys.byteorder == 'big':
+        items.byteswap()
+    return items
+
+
+def is_packed(data):
+    return data[:len(MAGIC)] == MAGIC
+
+
+def dumps(value):
+    """Pack value or fallback to JSON if it's not like {uid: dict}"""
+    fits = (
+        isinstance(value, dict)
+        and all(isinstance(v, dict) for v in value.values())
+        and all(isinstance(k, str) and _uint(k) is not None for k in value)
+    )
+    if not fits:
+        return json.dumps(value, sort_keys=True).encode()
+
+    table = []
+    numbers = []
+    # str, int and None values can't be equal to each other
+    scalars = {}
+    # others by type and value, dicts and lists by JSON
+    interned = {}
+    seen = {}
+
+    def intern(ref, val):
+        index = interned.get(ref)
+        if index is None:
+            index = interned[ref] = len(table)
+            table.append(val)
+        return index
+
+    def add_scalars(column):
+        vals = [v for v in dict.fromkeys(column) if v not in scalars]
+        nums = [
+            v for v in vals
+            if v.__class__ is str and v.isdigit() and _uint(v) is not None
+        ]
+        if nums:
+            # negative until the size of "table" is known
+            start = -1 - len(numbers)
+            scalars.update(zip(nums, range(start, start - len(nums), -1)))
+            numbers.extend(map(int, nums))
+            nums = set(nums)
+            vals = [v for v in vals if v not in nums]
+        scalars.update(zip(vals, range(len(table), len(table) + len(vals))))
+        table.extend(vals)
+        return map(scalars.__getitem__, column)
+
+    def add_objects(column):
+        # the same address is mostly the same object
+        ids = list(map(id, column))
+        for key, val in dict(zip(ids, column)).items():
+            if key not in seen:
+                seen[key] = intern(json.dumps(val, sort_keys=True), val)
+        return map(seen.__getitem__, ids)
+
+    def add_other(val):
+        if isinstance(val, (dict, list)):
+            return add_objects([val])
+        # True, 1 and 1.0 are different values here
+        return [intern((type(val).__name__, val), val)]
+
+    shapes = {}
+    for uid, record in value.items():
+        shapes.setdefault(tuple(sorted(record)), []).append(uid)
+
+    # values are grouped by keys, so columns are mostly of one type
+    uids = []
+    refs = []
+    for keys, found in shapes.items():
+        uids.extend(found)
+        records = [value[uid] for uid in found]
+        for key in keys:
+            column = [r[key] for r in records]
+            kinds = set(map(type, column))
+            if kinds <= {str, int, type(None)}:
+                refs.extend(add_scalars(column))
+            elif kinds <= {dict, list}:
+                refs.extend(add_objects(column))
+            else:
+                for val in column:
+                    if type(val) in (str, int, type(None)):
+                        refs.extend(add_scalars([val]))
+                    else:
+                        refs.extend(add_other(val))
+
+    size = len(table)
+    refs = (size - 1 - i if i < 0 else i for i in refs)
+    head = json.dumps({
+        'shapes': [list(i) for i in shapes],
+        'counts': [len(i) for i in shapes.values()]
+    }).encode()
+    parts = [
+        head,
+        json.dumps(table).encode(),
+        _array(int(i) for i in uids).tobytes(),
+        _array(numbers).tobytes(),
+    ]
+    lengths = header.pack(*(len(i) for i in parts))
+    parts.append(_array(refs).tobytes())
+    return b''.join([MAGIC, bytes([VERSION]), lengths] + parts)
+
+
+def loads(data):
+    """Unpack value, JSON is decoded as well"""
+    if not is_packed(data):
+        if isinstance(data, bytes):
+            data = data.decode()
+        return json.loads(data)
+
+    version = data[len(MAGIC)]
+    if version != VERSION:
+        raise Error('Unknown version: %s' % version)
+
+    data = memoryview(data)
+    start = len(MAGIC) + 1
+    lengths = header.unpack_from(data, start)
+    start += header.size
+    parts = []
+    for length in lengths:
+        parts.append(data[start:start + length])
+        start += length
+    head, table, uids, numbers = parts
+    head = json.loads(bytes(head))
+    table = json.loads(bytes(table))
+    table.extend(map(str, _unarray(numbers)))
+    uids = map(str, _unarray(uids))
+    values = map(table.__getitem__, _unarray(data[start:]))
+
+    # a lot of small dicts are created here and nothing to collect
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        value = {}
+        for keys, count in zip(head['shapes'], head['counts']):
+            columns = [list(islice(values, count)) for key in keys]
+            rows = zip(*columns) if keys else repeat((), count)
+            records = map(dict, map(zip, repeat(keys), rows))
+            value.update(zip(islice(uids, count), records))
+        return value
+    finally:
+        if enabled:
+            gc.enable()
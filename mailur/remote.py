@@ -71,13 +71,12 @@ class Remote(imaplib.IMAP4, imap.Conn):
     def open(self, host='', port=imaplib.IMAP4_SSL_PORT):
         super().open(host, port=imaplib.IMAP4_SSL_PORT)
 
-    def login(self):
-        return super().login(self.username, self.password)
-
 
 def connect():
     con = Remote()
-    imap.check(con.login())
+    imap.login(con, con.username, con.password)
+    # label and flag scans are compressed very well
+    imap.compress(con)
     return con
 
 
@@ -99,10 +98,9 @@ def fetch_imap(uids, box, tag=None, con=None):
         '\\Sent': '#sent',
     }
     exists = {}
-    res = con.fetch('1:*', 'BODY.PEEK[HEADER.FIELDS (X-SHA256)]')
-    for i in range(0, len(res), 2):
-        uid = res[i][0].decode().split()[2]
-        line = res[i][1].strip()
+    res = con.iter_fetch('1:*', 'BODY.PEEK[HEADER.FIELDS (X-SHA256)]')
+    for uid, attrs in res:
+        line = attrs['BODY[HEADER.FIELDS (X-SHA256)]'].strip()
         if not line:
             continue
         hash = email.message_from_bytes(line)['X-SHA256'].strip()
@@ -110,24 +108,15 @@ def fetch_imap(uids, box, tag=None, con=None):
 
     def msgs(con):
         account = data_account.get()
-        res = con.fetch(uids, '(UID INTERNALDATE FLAGS BODY.PEEK[])')
-        for i in range(0, len(res), 2):
-            line, raw = res[i]
+        fields = '(UID INTERNALDATE FLAGS BODY.PEEK[])'
+        # messages are streamed from one connection to another
+        for uid, attrs in con.iter_fetch(uids, fields):
+            raw = attrs['BODY[]']
             hash = hashlib.sha256(raw).hexdigest()
             if hash in exists:
                 continue
-            parts = re.search(
-                r'('
-                r'UID (?P<uid>\d+)'
-                r' ?|'
-                r'INTERNALDATE (?P<time>"[^"]+")'
-                r' ?|'
-                r'FLAGS \((?P<flags>[^)]*)\)'
-                r' ?){3}',
-                line.decode()
-            ).groupdict()
-
-            flags = parts['flags']
+
+            flags = attrs['FLAGS']
             if tag and tag in map_tags:
                 flags = ' '.join([flags, map_tags[tag]])
 
@@ -141,23 +130,19 @@ def fetch_imap(uids, box, tag=None, con=None):
             headers.append('')
             headers = '\r\n'.join(headers)
 
-            raw = headers.encode() + raw
-            yield parts['time'], flags, raw
+            # sent as is without copying the body
+            msg = (headers.encode(), raw)
+            yield '"%s"' % attrs['INTERNALDATE'], flags, msg
 
     with client(box=box, tag=tag) as c:
-        msgs = list(msgs(c))
-    if not msgs:
-        return None
-
-    return con.multiappend(local.SRC, msgs)
+        return con.multiappend(local.SRC, msgs(c))
 
 
 def uids_by_msgid_gmail(con):
     uids = {}
-    res = con.fetch('1:*', 'BODY.PEEK[HEADER.FIELDS (X-GM-MSGID)]')
-    for i in range(0, len(res), 2):
-        uid = res[i][0].decode().split()[2]
-        line = res[i][1].strip()
+    res = con.iter_fetch('1:*', 'BODY.PEEK[HEADER.FIELDS (X-GM-MSGID)]')
+    for uid, attrs in res:
+        line = attrs['BODY[HEADER.FIELDS (X-GM-MSGID)]'].strip()
         if not line:
             continue
         gid = email.message_from_bytes(line)['X-GM-MSGID'].strip()
@@ -217,66 +202,30 @@ def flags_by_gmail(tag, flags, labels):
 def fetch_gmail(uids, box, tag, con=None):
 
     existing = uids_by_msgid_gmail(con)
-    new_uids = []
-    with client(tag, box=box) as gm:
-        res = gm.fetch(uids.str, 'X-GM-MSGID')
-        for line in res:
-            parts = re.search(
-                r'('
-                r'UID (?P<uid>\d+)'
-                r' ?|'
-                r'X-GM-MSGID (?P<msgid>\d+)'
-                r' ?){2}',
-                line.decode()
-            ).groupdict()
-            if parts['msgid'] in existing:
-                continue
-            new_uids.append(parts['uid'])
-        if not new_uids:
-            log.debug('%s are alredy imported' % uids)
-            return
+
+    def msgs(gm, new_uids):
         fields = (
             '('
             'INTERNALDATE FLAGS BODY.PEEK[] '
             'X-GM-LABELS X-GM-MSGID X-GM-THRID'
             ')'
         )
-        res = gm.fetch(new_uids, fields)
-        login = gm.username
-
-    def msgs():
-        for i in range(0, len(res), 2):
-            line, raw = res[i]
-            parts = re.search(
-                r'('
-                r'UID (?P<uid>\d+)'
-                r' ?|'
-                r'INTERNALDATE (?P<time>"[^"]+")'
-                r' ?|'
-                r'FLAGS \((?P<flags>[^)]*)\)'
-                r' ?|'
-                r'X-GM-LABELS \((?P<labels>.*)\)'
-                r' ?|'
-                r'X-GM-MSGID (?P<msgid>\d+)'
-                r' ?|'
-                r'X-GM-THRID (?P<thrid>\d+)'
-                r' ?){6}',
-                line.decode()
-            ).groupdict()
-            if not raw or parts['msgid'] in existing:
+        for uid, attrs in gm.iter_fetch(new_uids, fields):
+            raw = attrs.get('BODY[]')
+            if not raw or attrs['X-GM-MSGID'] in existing:
                 # this happens in "[Gmail]/Chats" folder
                 continue
-            flags = flags_by_gmail(tag, parts['flags'], parts['labels'])
+            flags = flags_by_gmail(tag, attrs['FLAGS'], attrs['X-GM-LABELS'])
             if SKIP_DRAFTS and '\\Draft' in flags:
                 # TODO: skip drafts for now
                 continue
 
             headers = [
                 'X-SHA256: <%s>' % hashlib.sha256(raw).hexdigest(),
-                'X-GM-UID: <%s>' % parts['uid'],
-                'X-GM-MSGID: <%s>' % parts['msgid'],
-                'X-GM-THRID: <%s>' % parts['thrid'],
-                'X-GM-Login: <%s>' % login,
+                'X-GM-UID: <%s>' % uid,
+                'X-GM-MSGID: <%s>' % attrs['X-GM-MSGID'],
+                'X-GM-THRID: <%s>' % attrs['X-GM-THRID'],
+                'X-GM-Login: <%s>' % gm.username,
             ]
             thrid = thrid_re.search(flags)
             if thrid:
@@ -288,14 +237,22 @@ def fetch_gmail(uids, box, tag, con=None):
             headers.append('')
             headers = '\r\n'.join(headers)
 
-            raw = headers.encode() + raw
-            yield parts['time'], flags, raw
-
-    msgs = list(msgs())
-    if not msgs:
-        return None
+            # sent as is without copying the body
+            msg = (headers.encode(), raw)
+            yield '"%s"' % attrs['INTERNALDATE'], flags, msg
 
-    return con.multiappend(local.SRC, msgs)
+    new_uids = []
+    with client(tag, box=box) as gm:
+        res = gm.fetch(uids.str, 'X-GM-MSGID')
+        for uid, attrs in imap.fetch_items(res):
+            if attrs['X-GM-MSGID'] in existing:
+                continue
+            new_uids.append(uid)
+        if not new_uids:
+            log.debug('%s are alredy imported' % uids)
+            return
+        # messages are streamed from one connection to another
+        return con.multiappend(local.SRC, msgs(gm, new_uids))
 
 
 @fn_time
@@ -352,6 +309,19 @@ def get_folders():
         return items
 
 
+def watch(folders, handlers, timeout=None):
+    """Watch remote folders, one connection is used with NOTIFY"""
+    with client() as c:
+        boxes = []
+        for params in folders:
+            if params.get('box'):
+                boxes.append(params['box'])
+                continue
+            c.select_tag(params['tag'])
+            boxes.append(c.box)
+        c.watch({box: handlers for box in boxes}, timeout=timeout)
+
+
 @lock.user_scope('remote-sync')
 @local.using(local.SRC, reuse=False)
 def sync_gmail(con=None):
@@ -397,27 +367,16 @@ def sync_gmail(con=None):
     def sync_gmail_folder(gm, tag, flags_by_uid_local):
         actions = {}
         res = gm.fetch('1:*', '(UID X-GM-MSGID X-GM-LABELS FLAGS)')
-        for line in res:
-            parts = re.search(
-                r'('
-                r'UID (?P<uid>\d+)'
-                r' ?|'
-                r'FLAGS \((?P<flags>[^)]*)\)'
-                r' ?|'
-                r'X-GM-LABELS \((?P<labels>.*)\)'
-                r' ?|'
-                r'X-GM-MSGID (?P<msgid>\d+)'
-                r' ?){4}',
-                line.decode()
-            ).groupdict()
-            uid = parts['uid']
-            local_uid = uids_by_msgid.get(parts['msgid'])
+        for uid, attrs in imap.fetch_items(res):
+            local_uid = uids_by_msgid.get(attrs['X-GM-MSGID'])
             if not local_uid:
                 # skip, probably draft
                 continue
             if local_uid not in flags_by_uid_local:
                 continue
-            flags_remote = flags_by_gmail(tag, parts['flags'], parts['labels'])
+            flags_remote = flags_by_gmail(
+                tag, attrs['FLAGS'], attrs['X-GM-LABELS']
+            )
             flags_remote = set(flags_remote.split()) & flags_in_sync
             flags_local = flags_by_uid_local[local_uid]
             flags_to_add = flags_local - flags_remote
@@ -452,10 +411,8 @@ def sync_gmail(con=None):
     def sync_local(flags_by_uid_remote, con_src=None, con_all=None):
         actions = {}
         res = con_src.fetch(flags_by_uid_remote.keys(), '(UID FLAGS)')
-        for line in res:
-            pattern = r'UID (\d+) FLAGS \(([^)]*)\)'
-            uid, flags_local = re.search(pattern, line.decode()).groups()
-            flags_local = set(flags_local.split()) & flags_in_sync
+        for uid, flags in imap.fetch_flags(res):
+            flags_local = set(flags.split()) & flags_in_sync
             flags_remote = flags_by_uid_remote[uid]
             flags_to_add = flags_remote - flags_local
             if flags_to_add:
@@ -483,23 +440,11 @@ def sync_gmail(con=None):
                 % modseq_gmail
             )
             res = gm.fetch('1:*', fields)
-            for line in res:
-                parts = re.search(
-                    r'('
-                    r'UID (?P<uid>\d+)'
-                    r' ?|'
-                    r'FLAGS \((?P<flags>[^)]*)\)'
-                    r' ?|'
-                    r'X-GM-LABELS \((?P<labels>.*)\)'
-                    r' ?|'
-                    r'X-GM-MSGID (?P<msgid>\d+)'
-                    r' ?|'
-                    r'MODSEQ \(\d+\)'
-                    r' ?){5}',
-                    line.decode()
-                ).groupdict()
-                flags = flags_by_gmail(tag, parts['flags'], parts['labels'])
-                uid = uids_by_msgid.get(parts['msgid'])
+            for _, attrs in imap.fetch_items(res):
+                flags = flags_by_gmail(
+                    tag, attrs['FLAGS'], attrs['X-GM-LABELS']
+                )
+                uid = uids_by_msgid.get(attrs['X-GM-MSGID'])
                 if not uid:
                     # probably draft
                     continue
@@ -514,14 +459,10 @@ def sync_gmail(con=None):
 
         modseqs[modseq_key] = con.highestmodseq
         res = con.fetch('1:*', '(UID FLAGS) (CHANGEDSINCE %s)' % modseq_local)
-        for line in res:
-            val = re.search(
-                r'UID (\d+) FLAGS \(([^)]*)\) MODSEQ \(\d+\)',
-                line.decode()
-            )
-            if not val:
+        for uid, attrs in imap.fetch_items(res):
+            if 'FLAGS' not in attrs or 'MODSEQ' not in attrs:
                 continue
-            uid, flags = val.groups()
+            flags = attrs['FLAGS']
             flags_by_uid_local[uid] = set(flags.split()) & flags_in_sync
 
     def sync_flags(flags_by_uid_local, flags_by_uid_remote):
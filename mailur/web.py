@@ -98,10 +98,15 @@ def endpoint(callback):
     @jsonify
     @ft.wraps(callback)
     def inner(*args, **kwargs):
+        # pooled connections should select their mailboxes again
+        # to see changes made by other processes
+        imap.touch()
         try:
             return callback(*args, **kwargs)
         finally:
-            imap.clean_pool()
+            # connections are kept between requests,
+            # only stale ones are logged out here
+            imap.pool.expire()
     return inner
 
 
@@ -162,6 +167,7 @@ def logout():
     theme = request.session.get('theme')
     args = {'theme': theme} if theme else {}
     login_url = app.get_url('login', **args)
+    imap.clean_pool()
     request.session.clear()
     return redirect(login_url)
 
@@ -267,14 +273,27 @@ def filters():
 @endpoint
 def search():
     preload = request.json.get('preload')
+    # with "cursor" only one page of messages is sorted and sent
+    cursor = request.json.get('cursor')
+    if cursor is not None and (not isinstance(cursor, int) or cursor < 0):
+        return abort(400)
+
     q, opts = parse_query(request.json['q'])
     if opts.get('thread'):
         return thread(q, opts, preload)
 
+    paged = {}
     if opts.get('threads'):
         uids = local.search_thrs(opts.get('parts', q))
         info = ft.partial(local.thrs_info, tags=opts.get('tags'))
         info_url = app.get_url('thrs_info')
+    elif cursor is not None:
+        page = (cursor + 1, cursor + (preload or 200))
+        uids, count = local.search_msgs(q, partial=page)
+        info = local.msgs_info
+        info_url = app.get_url('msgs_info')
+        cursor += len(uids)
+        paged = {'count': count, 'cursor': cursor if cursor < count else None}
     else:
         uids = local.search_msgs(q)
         info = local.msgs_info
@@ -294,7 +313,7 @@ def search():
         'uids': uids,
         'msgs': msgs,
         'msgs_info': info_url
-    }, **{k: v for k, v in extra.items() if v})
+    }, **paged, **{k: v for k, v in extra.items() if v})
 
 
 @app.post('/thrs/info', name='thrs_info')
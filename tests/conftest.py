@@ -85,6 +85,8 @@ def setup(new_users, gm_client, sendmail, patch_conf):
     con_gmail.logout()
     imap.clean_pool(test1)
     imap.clean_pool(test2)
+    # LIST results are keyed by the same fake account in all tests
+    imap.clean_folders()
 
 
 @pytest.fixture
@@ -189,7 +191,7 @@ def gm_fake():
 
 @pytest.fixture
 def gm_client():
-    from mailur import local, message, remote
+    from mailur import imap, local, message, remote
 
     remote.SKIP_DRAFTS = False
 
@@ -278,8 +280,19 @@ def gm_client():
     gm_client.uid = 100
     gm_client.time = time.time() - 36000
 
+    iter_fetch_orig = imap._iter_fetch
+
+    def iter_fetch(con, uids, fields):
+        if not hasattr(con, '_uid'):
+            yield from iter_fetch_orig(con, uids, fields)
+            return
+        # fake Gmail responses are given by "uid" only
+        res = con.uid('FETCH', uids.str, fields)
+        yield from imap.fetch_items(res[1])
+
     with mock.patch('mailur.remote.connect', gm_fake):
-        yield gm_client
+        with mock.patch('mailur.imap._iter_fetch', iter_fetch):
+            yield gm_client
 
 
 def _msgs(box=None, uids='1:*', *, parsed=False, raw=False, policy=None):
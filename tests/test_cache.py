@@ -0,0 +1,47 @@
+from mailur import cache, conf
+
+
+def test_lru(patch):
+    user, another = ('%s_%s' % (i, conf['USER']) for i in ('lru1', 'lru2'))
+    limits = {'CACHE_MAX': 1000, 'CACHE_USER_MAX': 600, 'USER': user}
+    with patch.dict('mailur.conf', limits):
+        cache.set('one', 1, size=300)
+        cache.set('two', 2, size=300)
+        assert cache.get('one') == 1
+        assert cache.get('none') is None
+        assert cache.snapshot(user) == {
+            'hits': 1, 'misses': 1, 'evictions': 0,
+            'size': 600, 'entries': 2
+        }
+
+        # over the quota of the user, "two" is least recently used
+        cache.set('three', 3, size=100)
+        assert not cache.exists('two')
+        assert cache.get('one') == 1
+        assert cache.snapshot(user)['evictions'] == 1
+        assert cache.snapshot(user)['size'] == 400
+
+        # over the global limit, least recently used of all users
+        with patch.dict('mailur.conf', {'USER': another}):
+            cache.set('one', 1, size=700)
+            assert cache.snapshot(another)['size'] == 700
+        assert not cache.exists('three')
+        assert cache.exists('one')
+        assert cache.snapshot(user)['size'] == 300
+
+        # the latest value is kept even if it's too big
+        cache.set('big', 4, size=5000)
+        assert cache.get('big') == 4
+        assert cache.snapshot(user)['entries'] == 1
+        assert cache.snapshot(another)['entries'] == 0
+        assert cache.snapshot()['size'] == 5000
+
+        cache.rm('big')
+        assert cache.snapshot(user)['size'] == 0
+
+
+def test_sizeof():
+    assert cache.sizeof(1) < cache.sizeof('1' * 100) < cache.sizeof([1] * 100)
+    msgs = {str(i): {'uid': str(i), 'arrived': i} for i in range(10000)}
+    size = cache.sizeof(msgs)
+    assert cache.sizeof({}) < size // 10000 < cache.sizeof(msgs['1']) * 2
@@ -1,6 +1,6 @@
 import re
 
-from mailur import local, remote
+from mailur import imap, local, remote
 
 
 def test_client(some, patch, call):
@@ -10,7 +10,7 @@ def test_client(some, patch, call):
 
         assert set(con.__dict__.keys()) == set(
             '_con logout list select select_tag status search '
-            'fetch idle copy enable'
+            'fetch iter_fetch idle watch copy enable noop'
             .split()
         )
 
@@ -59,6 +59,10 @@ def test_account(gm_client):
     gm_client.list = [('OK', [
         b'(\\HasNoChildren) "/" INBOX',
     ])]
+    # LIST is cached for the account, so it isn't sent again
+    assert remote.get_folders() == [{'tag': '\\All'}]
+    assert gm_client.list
+    imap.clean_folders()
     assert remote.get_folders() == [{'box': 'INBOX', 'tag': '\\Inbox'}]
 
 
@@ -1,4 +1,7 @@
-from mailur import imap, local, message
+import time
+from array import array
+
+from mailur import conf, imap, local, message
 
 
 def test_batched_uids(gm_client):
@@ -44,6 +47,21 @@ def test_fn_parse_thread():
         ['130', '131', '132', '133', '134', '138', '139', '140'],
     )
     assert fn(b'(1)(2)(3)') == (['1'], ['2'], ['3'])
+    assert fn('') == () and fn('').all_uids == []
+    assert fn('((1)(2))(3)') == (['1', '2'], ['3'])
+    assert fn('((1)(2))((3)(4 5))') == (['1', '2'], ['3', '4', '5'])
+    # deep threads are parsed as well
+    line = '(%s%s(31)' % (' ('.join(map(str, range(1, 31))), ')' * 30)
+    assert fn(line) == ([str(i) for i in range(1, 31)], ['31'])
+
+    thrs = fn('(1)(2 3 (4)(5))', ints=True)
+    assert thrs == (array('I', [1]), array('I', [2, 3, 4, 5]))
+    assert thrs.all_uids == array('I', [1, 2, 3, 4, 5])
+
+    thrs = fn('(1)(2 3 (4)(5))', nested=True)
+    assert thrs == (['1'], ['2', '3', ['4'], ['5']])
+    assert thrs.all_uids == ['1', '2', '3', '4', '5']
+    assert fn(b'((1)(2))(3)', nested=True, ints=True) == ([[1], [2]], [3])
 
 
 def test_fn_pack_uids():
@@ -51,6 +69,337 @@ def test_fn_pack_uids():
     assert fn(['1', '2', '3', '4']) == '1:4'
     assert fn(['1', '3', '4']) == '1,3:4'
     assert fn(['100', '1', '4', '3', '10', '9', '8', '7']) == '1,3:4,7:10,100'
+    assert fn(['5', '5', '6']) == '5:6'
+    assert fn([]) == ''
+
+
+def test_fn_esearch():
+    ret = ['COUNT', 'MIN', 'MAX', 'ALL']
+    line = b'(TAG "A2") UID MIN 7 MAX 38 COUNT 3 ALL 7,37:38'
+    res = imap.parse_esearch(line, ret)
+    assert res == {'count': 3, 'min': 7, 'max': 38, 'all': '7,37:38'}
+    res = imap.parse_esearch(b'(TAG "A3") UID COUNT 0', ret)
+    assert res == {'count': 0, 'min': None, 'max': None, 'all': ''}
+    assert imap.parse_esearch(b'', ['ALL']) == {'all': ''}
+
+    ret = ['PARTIAL', 'COUNT']
+    line = b'(TAG "A4") UID PARTIAL (1:3 9,5:4) COUNT 10'
+    res = imap.parse_esearch(line, ret)
+    assert res == {'partial': '9,5:4', 'count': 10}
+    line = b'(TAG "A5") UID PARTIAL (1:3 NIL) COUNT 0'
+    assert imap.parse_esearch(line, ret) == {'partial': '', 'count': 0}
+
+    assert imap.unpack_uids('1:3,7,10:9') == array('I', [1, 2, 3, 7, 10, 9])
+    assert imap.unpack_uids('') == array('I')
+
+
+def test_fn_parse_vanished():
+    fn = imap.parse_vanished
+    assert fn([]) == []
+    assert fn([b'(EARLIER) 41,43:45', b'2']) == ['2', '41', '43', '44', '45']
+
+
+def test_fn_parse_status():
+    res = imap.parse_status(b'"mlr/All" (MESSAGES 5 UIDNEXT 6)')
+    assert res == ('mlr/All', {'MESSAGES': 5, 'UIDNEXT': 6})
+    res = imap.parse_status('mlr/Sys (HIGHESTMODSEQ 10)')
+    assert res == ('mlr/Sys', {'HIGHESTMODSEQ': 10})
+
+
+def test_fn_uids(raises):
+    uids = imap.Uids(['10', '3', '1', '2', '2'])
+    assert list(uids) == ['1', '2', '3', '10']
+    assert uids.str == '1:3,10'
+    assert len(uids) == 4
+    assert (uids - ['2', '3']).str == '1,10'
+    assert (uids | {'4', '11'}).str == '1:4,10:11'
+    assert (uids & imap.Uids(['1', '10', '12'])).str == '1,10'
+    assert not imap.Uids([]) and not (uids - uids)
+
+    uids = imap.Uids('1:*')
+    assert uids and uids.is_str and uids.str == '1:*'
+    with raises(TypeError):
+        uids - ['1']
+
+    uids = imap.Uids(range(1, 25001, 2), batch=5000)
+    assert [len(i) for i in uids.batches] == [5000, 5000, 2500]
+    assert uids.batches[-1].str.startswith('20001,20003,')
+
+
+def test_fn_batcher():
+    b = imap.Batcher(1000, 2, limits=(100, 5000, 4), seconds=10, size=2000)
+    # fast batch with small responses: grows, but not more than twice
+    b.done(1000, 1, 1000)
+    assert b.batch == 2000
+    b.done(2000, 1, 2000)
+    assert b.batch == 2000
+    # big responses: limited by size
+    b.done(2000, 1, 2 ** 20)
+    assert b.batch == 100
+
+    b = imap.Batcher(1000, 4, limits=(100, 5000, 4))
+    assert b.throttle() == 2
+    assert (b.batch, b.threads) == (500, 2)
+    assert b.throttle() == 4
+    assert (b.batch, b.threads) == (250, 1)
+    b.throttled = b.retries
+    assert b.throttle() is None
+
+    # explicit values extend limits
+    b = imap.Batcher(10, 16, limits=(100, 5000, 4))
+    assert (b.min_batch, b.max_threads) == (10, 16)
+
+
+def test_esearch(gm_client):
+    gm_client.add_emails([{}, {}, {}, {}], parse=False)
+    con = local.client(local.SRC, readonly=False)
+    con.store(['2', '3'], '+FLAGS', '#tag')
+    res = con.esearch('keyword #tag')
+    assert res == {'count': 2, 'min': 2, 'max': 3, 'all': '2:3'}
+    assert con.esearch('ALL', ret=['count']) == {'count': 4}
+    res = con.esearch('keyword #missing', ret=['COUNT', 'ALL'])
+    assert res == {'count': 0, 'all': ''}
+
+
+def test_sort_partial(gm_client, patch):
+    gm_client.add_emails([{}, {}, {}, {}, {}], parse=False)
+    con = local.client(local.SRC)
+    assert con.sort('(REVERSE ARRIVAL)', 'ALL') == ['5', '4', '3', '2', '1']
+
+    # Dovecot has ESORT, but not CONTEXT=SORT
+    caps = con._con.capabilities
+    assert 'ESORT' in caps and 'CONTEXT=SORT' not in caps
+    with patch.object(con._con, 'uid', wraps=con._con.uid) as m:
+        res = con.sort('(REVERSE ARRIVAL)', 'ALL', partial=(2, 3))
+        assert res == (['4', '3'], 5)
+        assert m.call_args[0][:2] == ('SORT', 'RETURN (ALL COUNT)')
+    res = con.sort('(REVERSE ARRIVAL)', 'ALL', partial=(5, 10))
+    assert res == (['1'], 5)
+    res = con.sort('(ARRIVAL)', 'keyword #missing', partial=(1, 10))
+    assert res == ([], 0)
+
+    # without ESORT the page is cut from the plain response
+    caps = tuple(i for i in caps if i != 'ESORT')
+    with patch.object(con._con, 'capabilities', caps):
+        res = con.sort('(REVERSE ARRIVAL)', 'ALL', partial=(2, 3))
+        assert res == (['4', '3'], 5)
+        res = con.sort('(ARRIVAL)', 'keyword #missing', partial=(1, 10))
+        assert res == ([], 0)
+
+
+def test_pipeline_broken(gm_client, patch, raises):
+    gm_client.add_emails([{}] * 3, parse=False)
+    con = local.client(local.SRC, readonly=False)
+    uids = imap.Uids(['1', '2', '3'], batch=1)
+    send = con._con.send
+
+    def broken(data):
+        if b' 2 +FLAGS' in data:
+            raise OSError('broken')
+        return send(data)
+
+    # an error of the sender isn't waited forever
+    with patch.object(con._con, 'send', broken):
+        with raises(OSError):
+            uids.pipeline(con._con, 'STORE', '+FLAGS.SILENT', '#1')
+    # the connection isn't used anymore
+    with raises(con.abort):
+        con.noop()
+
+
+def test_iter_fetch(gm_client):
+    gm_client.add_emails([{}, {}, {}], parse=False)
+    con = local.client(local.SRC)
+    res = con.iter_fetch('1:*', '(UID FLAGS BINARY.PEEK[1])')
+    uid, attrs = next(res)
+    assert uid == '1'
+    assert set(attrs) == {'UID', 'FLAGS', 'BINARY[1]'}
+    assert attrs['BINARY[1]'].strip() == b'42'
+
+    # the rest is read by closing
+    res.close()
+    assert con.search('ALL') == ['1', '2', '3']
+
+    res = con.iter_fetch(['1', '3'], 'FLAGS')
+    assert [uid for uid, attrs in res] == ['1', '3']
+    assert list(con.iter_fetch('10:*', 'FLAGS')) == []
+
+
+def test_fn_parse_fetch():
+    subj = 'BODY[HEADER.FIELDS (SUBJECT)]'
+    res = [
+        (b'1 (UID 5 %s {12}' % subj.encode(), b'Subject: 1\r\n'),
+        b')',
+        b'2 (UID 6 FLAGS (\\Seen #1) MODSEQ (12) X-GM-MSGID 10600)',
+        (b'3 (UID 7 BINARY[1] {3}', b'abc'),
+        (b' BINARY[2] {2}', b'de'),
+        b' FLAGS ())',
+    ]
+    assert [imap.parse_fetch(i) for i in imap.split_fetch(res)] == [
+        ('5', {'UID': '5', subj: b'Subject: 1\r\n'}),
+        ('6', {
+            'UID': '6', 'FLAGS': '\\Seen #1', 'MODSEQ': '12',
+            'X-GM-MSGID': '10600'
+        }),
+        ('7', {
+            'UID': '7', 'FLAGS': '', 'BINARY[1]': b'abc', 'BINARY[2]': b'de'
+        }),
+    ]
+    assert list(imap.fetch_items(res)) == [
+        imap.parse_fetch(i) for i in imap.split_fetch(res)
+    ]
+
+    res = [
+        b'1 (X-GM-MSGID 10100 X-GM-LABELS ("\\\\Inbox" "a \\"(b)" (c)) '
+        b'UID 101 INTERNALDATE "01-Jan-2020 10:00:00 +0000" FLAGS ())',
+        b'2 (X-GM-MSGID 10200 X-GM-LABELS () '
+        b'UID 102 INTERNALDATE "02-Jan-2020 10:00:00 +0000" FLAGS (\\Seen))',
+        b'3 (X-GM-MSGID 10300 UID 103 BODY[] NIL)',
+    ]
+    assert list(imap.fetch_items(res)) == [
+        ('101', {
+            'X-GM-MSGID': '10100', 'UID': '101', 'FLAGS': '',
+            'X-GM-LABELS': '"\\\\Inbox" "a \\"(b)" (c)',
+            'INTERNALDATE': '01-Jan-2020 10:00:00 +0000',
+        }),
+        ('102', {
+            'X-GM-MSGID': '10200', 'UID': '102', 'FLAGS': '\\Seen',
+            'X-GM-LABELS': '', 'INTERNALDATE': '02-Jan-2020 10:00:00 +0000',
+        }),
+        ('103', {'X-GM-MSGID': '10300', 'UID': '103', 'BODY[]': b''}),
+    ]
+    # lines are parsed as soon as they are received too
+    assert list(imap.fetch_items(iter(res))) == list(imap.fetch_items(res))
+
+    # quoted and NIL body sections are bytes like literals
+    res = [
+        b'1 (UID 1 BODY[HEADER.FIELDS (X-Checksum)] "X-Checksum: \\"1\\""'
+        b' BINARY[1] NIL)',
+    ]
+    assert list(imap.fetch_items(res)) == [('1', {
+        'UID': '1', 'BODY[HEADER.FIELDS (X-CHECKSUM)]': b'X-Checksum: "1"',
+        'BINARY[1]': b''
+    })]
+
+    res = [
+        b'1 (UID 1 FLAGS (\\Seen) MODSEQ (3))',
+        b'2 (UID 2 FLAGS ())',
+    ]
+    assert list(imap.fetch_items(res)) == [
+        ('1', {'UID': '1', 'FLAGS': '\\Seen', 'MODSEQ': '3'}),
+        ('2', {'UID': '2', 'FLAGS': ''}),
+    ]
+    assert list(imap.fetch_flags(res)) == [('1', '\\Seen'), ('2', '')]
+    # other shapes are parsed by "fetch_items"
+    res.append(b'3 (FLAGS (#1) UID 3)')
+    assert list(imap.fetch_flags(res)) == [
+        ('1', '\\Seen'), ('2', ''), ('3', '#1')
+    ]
+
+
+def test_fn_sendmsg(patch):
+    from gevent import socket, spawn
+
+    class Con:
+        def send(self, data):
+            self.sock.sendall(data)
+
+    def send(parts):
+        con = Con()
+        con.sock, dst = socket.socketpair()
+        received = spawn(lambda: dst.makefile('rb').read())
+        imap._sendmsg(con, parts)
+        con.sock.close()
+        return received.get()
+
+    parts = (b'X-Header: 1\r\n', memoryview(b'body' * 100000), b'')
+    assert send(parts) == b''.join(parts)
+
+    # SSL sockets don't support "sendmsg"
+    with patch('gevent.socket.socket.sendmsg') as m:
+        m.side_effect = NotImplementedError
+        assert send(parts) == b''.join(parts)
+        assert m.called
+
+
+def test_fn_get_response(raises):
+    import imaplib
+    import io
+    import re
+    import types
+
+    stream = io.BytesIO(
+        b'* 1 FETCH (UID 1 BODY[] {5}\r\nhello BODY[1] {3}\r\nabc)\r\n'
+        b'* 5 EXISTS\r\n'
+        b'* OK [UIDNEXT 7] Predicted\r\n'
+        b'* SEARCH\r\n'
+        b'+ idling\r\n'
+        b'A1 OK [APPENDUID 1 5] done\r\n'
+        b'A2 OK done\r\n'
+    )
+    con = types.SimpleNamespace(
+        readline=stream.readline, read=stream.read, debug=0,
+        untagged_responses={}, tagged_commands={b'A1': None},
+        tagre=re.compile(br'(?P<tag>A\d+) (?P<type>[A-Z]+) (?P<data>.*)'),
+        abort=imaplib.IMAP4.abort,
+    )
+    assert imap.get_response(con) == b'* 1 FETCH (UID 1 BODY[] {5}'
+    for i in range(3):
+        imap.get_response(con)
+    assert imap.get_response(con) is None
+    assert con.continuation_response == b'idling'
+    imap.get_response(con)
+    assert con.tagged_commands == {b'A1': ('OK', [b'[APPENDUID 1 5] done'])}
+    assert con.untagged_responses == {
+        'FETCH': [
+            (b'1 (UID 1 BODY[] {5}', b'hello'), (b' BODY[1] {3}', b'abc'),
+            b')'
+        ],
+        'EXISTS': [b'5'],
+        'OK': [b'[UIDNEXT 7] Predicted'],
+        'UIDNEXT': [b'7'],
+        'SEARCH': [b''],
+        'APPENDUID': [b'1 5'],
+    }
+    with raises(imaplib.IMAP4.abort) as e:
+        imap.get_response(con)
+    assert 'unexpected tagged response' in str(e.value)
+    with raises(imaplib.IMAP4.abort) as e:
+        imap.get_response(con)
+    assert 'EOF' in str(e.value)
+
+
+def test_fn_deflate():
+    import zlib
+
+    from gevent import socket, spawn
+
+    sock, peer = socket.socketpair()
+    con = imap.Deflate(sock, sock.makefile('rb'))
+    deflate = zlib.compressobj(6, zlib.DEFLATED, -15)
+    inflate = zlib.decompressobj(-15)
+
+    def send(data):
+        data = deflate.compress(data) + deflate.flush(zlib.Z_SYNC_FLUSH)
+        # by small chunks to check buffering
+        for i in range(0, len(data), 7):
+            peer.sendall(data[i:i+7])
+
+    con.sendall(b'A1 NOOP\r\n')
+    assert inflate.decompress(peer.recv(1024)) == b'A1 NOOP\r\n'
+
+    literal = b'x' * 100000
+    spawn(send, b'* 1 FETCH (BODY[] {100000}\r\n%s)\r\nA1 OK\r\n' % literal)
+    assert con.readline() == b'* 1 FETCH (BODY[] {100000}\r\n'
+    assert con.read(100000) == literal
+    assert con.readline(3) == b')\r\n'
+    assert con.readline(2) == b'A1'
+    assert con.readline() == b' OK\r\n'
+
+    peer.close()
+    assert con.readline() == b''
+    con.close()
+    con.shutdown(socket.SHUT_RDWR)
 
 
 def test_literal_size_limit(gm_client, raises):
@@ -69,7 +418,7 @@ def test_literal_size_limit(gm_client, raises):
     assert 'Too long argument' in str(e.value)
 
 
-def test_multiappend(patch, msgs):
+def test_multiappend(patch, msgs, raises):
     new = [
         (None, None, message.binary(str(i)).as_bytes())
         for i in range(0, 10)
@@ -99,6 +448,218 @@ def test_multiappend(patch, msgs):
     con.multiappend(local.SRC, new, batch=3)
     assert len(msgs(local.SRC)) == 20
 
+    # non-synchronizing literals
+    assert 'LITERAL+' in con._con.capabilities
+    send = con._con.send
+    with patch.object(con._con, 'send', wraps=send) as m:
+        con.multiappend(local.SRC, new[:2])
+        line = m.call_args_list[0][0][0]
+        assert line.endswith(b' {%d+}\r\n' % len(new[0][2]))
+    assert len(msgs(local.SRC)) == 22
+
+    with patch.object(con._con, 'capabilities', ('IMAP4REV1',)):
+        con.multiappend(local.SRC, new[:2])
+    assert len(msgs(local.SRC)) == 24
+
+    # streaming from iterator
+    size = len(new[0][2])
+    res = con.multiappend(local.SRC, iter(new), limit=size * 4)
+    assert len(res.split(',')) == 3
+    assert len(msgs(local.SRC)) == 34
+    assert con.multiappend(local.SRC, iter([])) is None
+
+    def broken():
+        yield new[0]
+        raise ValueError('broken')
+
+    with raises(ValueError):
+        con.multiappend(local.SRC, broken())
+    assert len(msgs(local.SRC)) == 34
+    # the broken connection isn't used anymore
+    with raises(con.abort):
+        con.noop()
+
+
+def test_move_and_expunge(gm_client, msgs):
+    gm_client.add_emails([{}] * 4, parse=False)
+    con = local.client(local.SRC, readonly=False)
+
+    # deleted by another client, it isn't expunged with uids
+    con.store(['1', '2'], '+FLAGS.SILENT', '\\Deleted')
+    con.expunge(['2'])
+    assert [i['uid'] for i in msgs(local.SRC)] == ['1', '3', '4']
+    assert con.expunge([]) == []
+
+    con.move(['3', '4'], local.DEL)
+    assert [i['uid'] for i in msgs(local.SRC)] == ['1']
+    assert len(msgs(local.DEL)) == 2
+    assert con.move([], local.DEL) == []
+
+
+def test_pool(patch):
+    from gevent import spawn
+
+    pool = imap.Connections(2, 60)
+    c1 = pool.get('1', lambda: local.client(None))
+    assert pool.get('1', lambda: local.client(None)) is c1
+    c2 = pool.get('2', lambda: local.client(None))
+    c3 = pool.get('3', lambda: local.client(None))
+    assert pool.keys() == ['2', '3']
+    assert pool.get('2', lambda: local.client(None)) is c2
+    assert pool.keys() == ['3', '2']
+
+    # dead connection is replaced after NOOP check
+    c2.logout()
+    with patch.object(pool, 'check', -1):
+        assert pool.get('2', lambda: local.client(None)) is not c2
+    assert pool.get('3', lambda: local.client(None)) is c3
+
+    # connection locked by another greenlet is kept
+    spawn(c3.lock.acquire).join()
+    with patch.object(pool, 'ttl', -1):
+        pool.expire()
+    assert pool.keys() == ['3']
+    pool.get('4', lambda: local.client(None))
+    pool.get('5', lambda: local.client(None))
+    assert pool.keys() == ['3', '5']
+
+
+def test_pool_broken(raises):
+    @imap.using(local.client, local.ALL)
+    def search(con):
+        return con, con.search('ALL')
+
+    con, uids = search()
+    # like after restart of the server, the next web request
+    # changes the epoch, so the mailbox is selected again
+    con._con.shutdown()
+    imap.touch()
+    new, found = search()
+    assert new is not con
+    assert found == uids
+    assert con.broken
+
+    # failed command drops the connection whatever the idle time
+    new._con.shutdown()
+    with raises((imap.Error, OSError)):
+        new.search('ALL')
+    assert new.broken
+    assert search()[0] is not new
+
+
+def test_select_cached(patch):
+    con = local.client(None)
+    con.select(local.ALL)
+    stats = imap.stats.copy()
+
+    def count(*names):
+        return tuple(imap.stats[i] - stats[i] for i in names)
+
+    def sent():
+        # each command is one round trip
+        found = tags.call_count
+        tags.reset_mock()
+        return found
+
+    names = 'select', 'select_skipped', 'select_noop'
+    raw = con._con
+    with patch.object(raw, '_new_tag', wraps=raw._new_tag) as tags:
+        con.select(local.ALL, cached=True)
+        assert count(*names) == (0, 1, 0)
+        assert sent() == 0
+
+        con.select(local.ALL, readonly=False, cached=True)
+        assert count(*names) == (1, 1, 0)
+        assert sent() == 1
+
+        con.select(local.ALL, readonly=False, cached=True)
+        assert count(*names) == (1, 2, 0)
+        assert sent() == 0
+
+        # any modification changes the epoch
+        con.store('1:*', '+FLAGS.SILENT', '#1')
+        con.select(local.ALL, readonly=False, cached=True)
+        assert count(*names) == (2, 2, 0)
+        assert sent() == 2
+
+        imap.touch()
+        con.select(local.ALL, readonly=False, cached=True)
+        assert count(*names) == (3, 2, 0)
+        assert sent() == 1
+
+        # without "cached" it is always selected
+        con.select(local.ALL, readonly=False)
+        assert count(*names) == (4, 2, 0)
+        assert sent() == 1
+
+        # changes from another process don't change the epoch,
+        # they are checked by NOOP only if the server wasn't heard
+        con.select(local.SRC, cached=True)
+        uidnext = con.uidnext
+        epoch = imap.epochs[conf['USER']]
+        other = local.client(None)
+        other.append(local.SRC, None, None, b'Subject: other\r\n\r\nbody')
+        imap.epochs[conf['USER']] = epoch
+        sent()
+        con.select(local.SRC, cached=True)
+        assert count(*names) == (5, 3, 0)
+        assert sent() == 0
+        assert con.uidnext == uidnext
+
+        with patch.object(imap.pool, 'check', -1):
+            con.select(local.SRC, cached=True)
+            assert count(*names) == (6, 3, 0)
+            assert sent() == 2
+            assert con.uidnext == uidnext + 1
+
+            con.select(local.SRC, cached=True)
+            assert count(*names) == (6, 3, 1)
+            assert sent() == 1
+
+        # updates received with responses of other commands
+        raw.untagged_responses['EXISTS'] = [b'3']
+        con.select(local.SRC, cached=True)
+        assert count(*names) == (7, 3, 1)
+        assert sent() == 1
+        assert 'EXISTS' not in raw.untagged_responses
+    other.logout()
+
+
+def test_metrics(gm_client, patch):
+    gm_client.add_emails([{}] * 2)
+    imap.metrics_snapshot(reset=True)
+    con = local.client()
+    con.search('ALL')
+    con.search('ALL')
+    con.fetch('1:*', 'FLAGS')
+
+    res = imap.metrics_snapshot(conf['USER'])
+    item = res[conf['USER'], local.ALL, 'search']
+    assert item['calls'] == 2
+    assert item['errors'] == 0
+    assert item['sent'] > 0
+    assert item['received'] > 0
+    assert sum(item['latency']) == 2
+    assert res[conf['USER'], local.ALL, 'fetch']['calls'] == 1
+    assert imap.metrics_snapshot('another') == {}
+
+    # time of the consumer between items isn't counted
+    imap.metrics_snapshot(reset=True)
+    for uid, attrs in con.iter_fetch('1:*', 'FLAGS'):
+        time.sleep(0.2)
+    item = imap.metrics_snapshot()[conf['USER'], local.ALL, 'iter_fetch']
+    assert item['calls'] == 1
+    assert item['errors'] == 0
+    assert item['server'] + item['client'] < 0.2
+
+    # the oldest keys are dropped
+    with patch.object(imap, 'metrics_limit', 1):
+        con.search('ALL')
+        con.fetch('1:*', 'FLAGS')
+    assert list(imap.metrics_snapshot()) == [
+        (conf['USER'], local.ALL, 'fetch')
+    ]
+
 
 def test_idle():
     def handler(res):
@@ -113,6 +674,81 @@ def test_idle():
     assert not con.idle({'EXISTS': handler}, timeout=1)
 
 
+def test_watch(patch):
+    con = local.client(None)
+    handlers = {
+        local.SRC: {'FETCH': lambda res: None},
+        local.ALL: {'VANISHED': lambda res: None},
+        local.SYS: {'EXISTS': lambda res: None},
+    }
+    # just check if timeout works
+    assert not con.watch(handlers, timeout=1)
+    assert con.box == local.SRC
+
+    # without NOTIFY each extra mailbox is idling on its own connection
+    idle = imap.idle
+    idling = []
+    conns = set()
+
+    def idle_box(c, found, timeout=None):
+        idling.append((c.current_box, found))
+        conns.add(id(c))
+        return idle(c, found, timeout)
+
+    caps = con._con.capabilities
+    con._con.capabilities = tuple(i for i in caps if i != 'NOTIFY')
+    with patch('mailur.imap.idle', idle_box):
+        assert not con.watch(handlers, timeout=1)
+    con._con.capabilities = caps
+    assert sorted(idling) == sorted(handlers.items())
+    assert len(conns) == 3
+
+
+def test_watch_status(patch):
+    con = local.client(None)
+    called = []
+
+    def handler(box, code):
+        return lambda res: called.append((box, code))
+
+    handlers = {
+        box: {code: handler(box, code) for code in codes}
+        for box, codes in (
+            (local.SRC, ('EXISTS', 'FETCH')),
+            (local.ALL, ('EXISTS', 'VANISHED', 'FETCH')),
+        )
+    }
+    events = [
+        # the first one is right after NOTIFY SET
+        ('STATUS', '"%s" (MESSAGES 2 UIDNEXT 3 HIGHESTMODSEQ 5)'),
+        ('STATUS', '"%s" (MESSAGES 3 UIDNEXT 4 HIGHESTMODSEQ 6)'),
+        # appended and expunged
+        ('STATUS', '"%s" (MESSAGES 3 UIDNEXT 5 HIGHESTMODSEQ 8)'),
+        ('STATUS', '"%s" (MESSAGES 2 HIGHESTMODSEQ 9)'),
+        ('STATUS', '"%s" (HIGHESTMODSEQ 10)'),
+        ('FETCH', '1 (UID 1 FLAGS (\\Seen))'),
+    ]
+
+    def idle(con, match, timeout):
+        for code, line in events:
+            line = (line % local.ALL if code == 'STATUS' else line).encode()
+            con.untagged_responses.setdefault(code, []).append(line)
+            match()
+            called.append(None)
+
+    with patch('mailur.imap._idle', idle):
+        con.watch(handlers)
+    assert called == [
+        None,
+        (local.ALL, 'EXISTS'), (local.ALL, 'FETCH'), None,
+        (local.ALL, 'EXISTS'), (local.ALL, 'VANISHED'),
+        (local.ALL, 'FETCH'), None,
+        (local.ALL, 'VANISHED'), (local.ALL, 'FETCH'), None,
+        (local.ALL, 'FETCH'), None,
+        (local.SRC, 'FETCH'), None,
+    ]
+
+
 def test_sieve(gm_client, msgs, raises, some):
     gm_client.add_emails([
         {'from': '"A" <A@t.com>'},
@@ -1,4 +1,164 @@
-from mailur import local
+import imaplib
+import pathlib
+
+import pytest
+
+from mailur import cache, conf, json, local, pack
+
+
+def test_metadata_log(gm_client, patch):
+    gm_client.add_emails([{}, {}])
+    pairs = local.data_uidpairs.get()
+    assert sorted(pairs) == ['1', '2']
+
+    def subjects():
+        uids = local.metadata_uids()
+        return {k: v for k, v in uids.items() if k.startswith('uidpairs')}
+
+    snapshot = subjects()['uidpairs']
+    gm_client.add_emails([{}])
+    assert subjects()['uidpairs'] == snapshot
+    assert len(subjects()['uidpairs.log']) == 1
+
+    # unchanged value isn't saved again
+    local.data_uidpairs(local.data_uidpairs.get())
+    assert len(subjects()['uidpairs.log']) == 1
+
+    pairs = local.data_uidpairs.get()
+    pairs.pop('1')
+    local.data_uidpairs(pairs)
+    assert len(subjects()['uidpairs.log']) == 2
+
+    # patches are applied by a fresh reader
+    cache.clear()
+    assert sorted(local.data_uidpairs.get()) == ['2', '3']
+
+    # and then a full snapshot is saved again
+    with patch.dict('mailur.conf', {'METADATA_LOG': 2}):
+        gm_client.add_emails([{}])
+    assert subjects()['uidpairs'] != snapshot
+    assert 'uidpairs.log' not in subjects()
+    cache.clear()
+    assert sorted(local.data_uidpairs.get()) == ['2', '3', '4']
+
+
+def test_metadata_shards(gm_client):
+    @local.metadata('test', lambda: [{}, {}], shard=2)
+    def data_test(one, two):
+        return [one, two]
+
+    def subjects():
+        uids = local.metadata_uids()
+        return {k: v for k, v in uids.items() if k.startswith('test')}
+
+    data_test({'1': 1, '2': 2, '3': 3}, {'5': 5})
+    saved = subjects()
+    assert sorted(saved) == ['test/0000', 'test/0001', 'test/0002']
+
+    one, two = data_test.get()
+    two['5'] = 55
+    data_test(one, two)
+    assert subjects() == dict(saved, **{'test/0002': subjects()['test/0002']})
+    assert subjects()['test/0002'] != saved['test/0002']
+
+    # only needed shards are fetched by a fresh reader
+    cache.clear()
+    assert data_test.get(['5']) == [{}, {'5': 55}]
+    assert data_test.get(['1', '2']) == [{'1': 1, '2': 2, '3': 3}, {}]
+
+    one, two = data_test.get()
+    one.pop('1')
+    data_test(one, two)
+    assert subjects()['test/0000'] != saved['test/0000']
+    cache.clear()
+    assert data_test.get() == [{'2': 2, '3': 3}, {'5': 55}]
+
+
+def test_metadata_shards_migrate(gm_client):
+    @local.metadata('test', dict, log=True)
+    def data_legacy(value):
+        return value
+
+    @local.metadata('test', dict, shard=2)
+    def data_test(value):
+        return value
+
+    def subjects():
+        uids = local.metadata_uids()
+        return sorted(k for k in uids if k.startswith('test'))
+
+    data_legacy({'1': 1})
+    data_legacy({'1': 1, '2': 2})
+    assert subjects() == ['test', 'test.log']
+
+    # the legacy value is read until the first sharded save
+    cache.clear()
+    assert data_test.get() == {'1': 1, '2': 2}
+    data_test(dict(data_test.get(), **{'3': 3}))
+    assert subjects() == ['test/0000', 'test/0001']
+    cache.clear()
+    assert subjects() == ['test/0000', 'test/0001']
+    assert data_test.get() == {'1': 1, '2': 2, '3': 3}
+
+
+def test_metadata_disk(gm_client, patch):
+    gm_client.add_emails([{}])
+    assert local.data_uidpairs.get() == {'1': '1'}
+
+    # a fresh process gets values from the disk cache
+    cache.clear()
+    with patch('mailur.cache.disk_set') as m:
+        assert local.data_uidpairs.get() == {'1': '1'}
+        assert local.data_msgs.get(['1'])['1']['origin_uid'] == '1'
+        assert not m.called
+
+    cache.clear()
+    with patch.dict('mailur.conf', {'CACHE_DIR': None}):
+        with patch('mailur.cache.disk_set') as m:
+            assert local.data_uidpairs.get() == {'1': '1'}
+            assert m.called
+
+    # settings (with passwords) never go to the disk cache
+    with patch('mailur.cache.disk_set') as m:
+        local.data_settings({'secret': 'pwd'})
+        cache.clear()
+        assert local.data_settings.get()['secret'] == 'pwd'
+        assert not m.called
+
+    # the cache is private
+    path = pathlib.Path(conf['CACHE_DIR'])
+    assert path.stat().st_mode & 0o777 == 0o700
+    files = list(path.glob('*.sqlite'))
+    assert files
+    assert {i.stat().st_mode & 0o777 for i in files} == {0o600}
+
+
+def test_pack():
+    addr = {'addr': 'a@t.com', 'name': 'a', 'title': 'a@t.com', 'hash': ''}
+    msgs = {
+        '1': {'arrived': 1, 'origin_uid': '10', 'from': addr, 'parent': None},
+        '2': {'arrived': 2, 'origin_uid': '02', 'from': addr, 'parent': '1'},
+        '10': {'msgid': '<a@t.com>', 'flag': True, 'size': 1.0},
+        '12': {},
+    }
+    data = pack.dumps(msgs)
+    assert pack.is_packed(data)
+    assert len(data) < len(json.dumps(msgs))
+    value = pack.loads(data)
+    assert value == msgs
+    assert value['2']['origin_uid'] == '02'
+    assert value['10']['flag'] is True
+    assert value['1']['from'] is value['2']['from']
+
+    # JSON is used for other values and it's read as well
+    for value in ({'a': 1}, [{'1': 1}, {}], {'01': {}}, {'1': 1}):
+        data = pack.dumps(value)
+        assert not pack.is_packed(data)
+        assert pack.loads(data) == value
+        assert pack.loads(data.decode()) == value
+
+    with pytest.raises(pack.Error):
+        pack.loads(b'MLR\xff')
 
 
 def test_uidpairs(gm_client, msgs, patch, call):
@@ -33,15 +193,23 @@ def test_uidpairs(gm_client, msgs, patch, call):
     local.data_threads.get()
     local.data_msgids.get()
     settings = local.data_settings.get()
-    with patch('imaplib.IMAP4.uid') as m:
+    send = imaplib.IMAP4.send
+    with patch('imaplib.IMAP4.uid') as m, \
+            patch.object(imaplib.IMAP4, 'send', autospec=True) as s:
+        s.side_effect = send
         m.return_value = 'OK', []
         local.update_metadata('4')
         assert m.called
         assert m.call_args_list == [
-            call('FETCH', '4', '(FLAGS BINARY.PEEK[1])'),
-            call('FETCH', '1:*', '(UID BODY[HEADER.FIELDS (Subject)])'),
             call('THREAD', 'REFS UTF-8 INTHREAD REFS UID 4'),
         ]
+        fetches = [
+            i[0][1].split(b' ', 1)[1] for i in s.call_args_list
+            if b' UID FETCH ' in i[0][1]
+        ]
+        assert fetches == [
+            b'UID FETCH 4 (FLAGS BINARY.PEEK[1])\r\n',
+        ]
     local.data_settings(settings)
 
     patched = {'wraps': local.update_metadata}
@@ -83,6 +251,23 @@ def test_update_metadata(gm_client, msgs, patch, call):
     assert {'3': '4', '4': '4'} == thrids
 
 
+def test_sync_vanished(gm_client):
+    gm_client.add_emails([{}, {}, {'refs': '<102@mlr>'}])
+    local.sync_vanished()
+    assert local.data_qresync.get()
+    assert local.data_threads.get()[0] == {'1': '1', '2': '3', '3': '3'}
+
+    # expunged by another client, metadata isn't touched
+    con = local.client(readonly=False)
+    con.store(['1', '3'], '+FLAGS.SILENT', '\\Deleted')
+    con.expunge()
+    assert set(local.data_msgs.get()) == {'1', '2', '3'}
+
+    local.sync_vanished()
+    assert set(local.data_msgs.get()) == {'2'}
+    assert local.data_threads.get()[0] == {'2': '2'}
+
+
 def test_data_threads(gm_client):
     gm_client.add_emails([{'subj': 'new subj'}])
     assert local.data_threads.get()[1] == {'1': ['1']}
@@ -3,7 +3,7 @@ from unittest.mock import patch
 from gevent import sleep, spawn
 from pytest import mark
 
-from mailur import cli, conf, local, remote
+from mailur import cli, conf, imap, local, remote
 
 
 def test_local(gm_client, msgs):
@@ -218,6 +218,7 @@ def test_cli_idle_general_imap(gm_client, msgs, login, patch):
     gm_client.list = []
     xlist = [('OK', [b'(\\HasNoChildren) "/" INBOX'])] * 10
     with patch.object(gm_client, 'list', xlist):
+        imap.clean_folders()
         spawn(lambda: cli.main('%s sync --timeout=300' % login.user1))
         sleep(2)
 
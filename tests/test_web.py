@@ -611,6 +611,34 @@ def test_msgs_flag(gm_client, login, msgs):
     ]
 
 
+def test_search_cursor(gm_client, login, some):
+    web = login()
+    res = web.search({'q': '', 'cursor': 0})
+    assert res == {
+        'uids': [],
+        'msgs': {},
+        'msgs_info': '/msgs/info',
+        'count': 0,
+        'cursor': None,
+    }
+
+    gm_client.add_emails([{} for i in range(5)])
+    res = web.search({'q': '', 'cursor': 0, 'preload': 2})
+    assert res == {
+        'uids': ['5', '4'],
+        'msgs': {'5': some, '4': some},
+        'msgs_info': '/msgs/info',
+        'count': 5,
+        'cursor': 2,
+    }
+    res = web.search({'q': '', 'cursor': 2, 'preload': 2})
+    assert [res['uids'], res['cursor']] == [['3', '2'], 4]
+    res = web.search({'q': '', 'cursor': 4, 'preload': 2})
+    assert [res['uids'], res['cursor'], res['count']] == [['1'], None, 5]
+
+    web.search({'q': '', 'cursor': -1}, status=400)
+
+
 def test_search_thread(gm_client, login, some):
     def post(uid, preload=4):
         data = {'q': 'thread:%s' % uid, 'preload': preload}